@@ -4,6 +4,7 @@
 
 from __future__ import print_function, division
 import chimera.extension
+import Midas.midas_text
 
 
 class PoPMuSiCExtension(chimera.extension.EMO):
@@ -24,4 +25,11 @@ class PoPMuSiCExtension(chimera.extension.EMO):
         self.module('gui').showUI()
 
 
-chimera.extension.manager.registerExtension(PoPMuSiCExtension(__file__))
+emo = PoPMuSiCExtension(__file__)
+chimera.extension.manager.registerExtension(emo)
+
+
+def cmd_popmusic(cmdName, args):
+    emo.module('command').popmusic(cmdName, args)
+
+Midas.midas_text.addCommand('popmusic', cmd_popmusic, help=False)
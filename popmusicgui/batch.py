@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Headless generation of mutant structures with a pool of Chimera processes.
+
+Each worker is a `chimera --nogui` process that receives a chunk of jobs,
+applies them with `core.Controller.apply_mutation` on a fresh copy of the
+structure and writes one PDB file per job. Finished jobs are reported on
+the worker's stdout and appended to `manifest.jsonl` in the output
+directory as soon as they arrive.
+
+Usage (with a Chimera-enabled interpreter, like pychimera)::
+
+    python -m popmusicgui.batch structure.pdb result.pops result.pop outdir --top 20 --workers 4
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+MARKER = 'POPMUSIC_JOB '
+
+
+def mutant_jobs(model, top=10, suggested=True):
+    """
+    Build the job list for the `top` best single mutants and, optionally,
+    the combined mutant with the best mutation of each favourable residue
+    (as in `Controller.apply_favourable_mutations`).
+
+    Returns
+    -------
+    list of dict
+        {'id': str, 'mutations': [[chain, position, new_type], ...]}
+    """
+    jobs = []
+    for m in model.top_mutations(top, stabilizing=True):
+        jobs.append({'id': '{}{}{}'.format(m.chain, m.id, m.residue_mutated),
+                     'mutations': [[m.chain, m.id, m.residue_mutated]]})
+    if suggested:
+        combined = []
+        for r in model.residues:
+            if r.mutations and (r.negative_score + r.positive_score) < 0:
+                new_type, values = min(r.mutations.items(), key=lambda kv: kv[1].ddG)
+                if values.ddG < 0:
+                    combined.append([r.chain, r.id, new_type])
+        if combined:
+            jobs.append({'id': 'suggested', 'mutations': combined})
+    return jobs
+
+
+def run_batch(structure, jobs, outdir, workers=4, chimera='chimera', criteria='chp'):
+    """
+    Distribute `jobs` among `workers` headless Chimera processes.
+
+    Parameters
+    ----------
+    structure : str
+        Path to the wild type structure
+    jobs : list of dict
+        As returned by `mutant_jobs`
+    outdir : str
+        Output directory for the PDB files and the manifest
+    workers : int, optional
+        Number of Chimera processes
+    chimera : str, optional
+        Chimera executable
+    criteria : str, optional
+        Rotamer criteria. See `Controller.apply_mutation`.
+
+    Returns
+    -------
+    list of dict
+        Manifest records, in order of completion. The manifest is
+        rewritten on every run.
+    """
+    if not jobs:
+        return []
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    manifest_path = os.path.join(outdir, 'manifest.jsonl')
+    open(manifest_path, 'w').close()  # Drop the records of previous runs
+    workers = max(1, min(workers, len(jobs)))
+    chunks = [jobs[i::workers] for i in range(workers)]
+    records, lock = [], threading.Lock()
+
+    def report(record):
+        with lock:
+            records.append(record)
+            with open(manifest_path, 'a') as manifest:
+                manifest.write(json.dumps(record) + '\n')
+
+    def collect(process):
+        for line in iter(process.stdout.readline, b''):
+            line = line.decode('utf-8') if not isinstance(line, str) else line
+            if line.startswith(MARKER):
+                report(json.loads(line[len(MARKER):]))
+
+    processes, threads, job_files = [], [], []
+    try:
+        for chunk in chunks:
+            fd, job_file = tempfile.mkstemp(suffix='.json', prefix='popmusic_jobs_')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(chunk, f)
+            job_files.append(job_file)
+            script = '"{}" --worker "{}" "{}" "{}" {}'.format(os.path.abspath(__file__), structure,
+                                                             job_file, outdir, criteria)
+            process = subprocess.Popen([chimera, '--nogui', '--nostatus', '--silent', '--script', script],
+                                       stdout=subprocess.PIPE)
+            thread = threading.Thread(target=collect, args=(process,))
+            thread.daemon = True
+            thread.start()
+            processes.append(process)
+            threads.append(thread)
+        for chunk, process, thread in zip(chunks, processes, threads):
+            process.wait()
+            thread.join()
+            # A worker that died (e.g. failing to import) leaves its jobs unreported
+            reported = set(record['id'] for record in records)
+            for job in chunk:
+                if job['id'] not in reported:
+                    report({'id': job['id'], 'mutations': job['mutations'], 'status': 'error',
+                            'error': 'Worker exited with code {} before reporting this job'.format(
+                                process.returncode)})
+    finally:
+        for job_file in job_files:
+            os.remove(job_file)
+    return records
+
+
+def worker(structure, jobs_path, outdir, criteria='chp'):
+    """
+    Worker entry point, run inside a headless Chimera
+    """
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import chimera
+    from Midas import write
+    from core import Controller
+
+    with open(jobs_path) as f:
+        jobs = json.load(f)
+    basename = os.path.splitext(os.path.basename(structure))[0]
+    for job in jobs:
+        start = time.time()
+        record = {'id': job['id'], 'mutations': job['mutations']}
+        molecule = chimera.openModels.open(structure)[0]
+        try:
+            for chain, position, new_type in job['mutations']:
+                residue = molecule.findResidue(chimera.MolResId(chain, position))
+                if residue is None:
+                    raise ValueError('Residue {}.{} not found'.format(position, chain))
+                Controller.apply_mutation(residue, new_type, criteria=criteria, use_cache=False)
+            path = os.path.join(outdir, '{}_{}.pdb'.format(basename, job['id']))
+            write([molecule], None, path)
+        except Exception as e:
+            record.update(status='error', error=str(e))
+        else:
+            record.update(status='ok', path=path)
+        finally:
+            chimera.openModels.close([molecule])
+        record['seconds'] = round(time.time() - start, 3)
+        print(MARKER + json.dumps(record))
+        sys.stdout.flush()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == '--worker':
+        return worker(*argv[1:])
+    parser = argparse.ArgumentParser(description='Generate mutant structures from PoPMuSiC results')
+    parser.add_argument('structure', help='Wild type structure (PDB)')
+    parser.add_argument('pops', help='Path to .pops file')
+    parser.add_argument('pop', help='Path to .pop file')
+    parser.add_argument('outdir', help='Output directory')
+    parser.add_argument('--top', type=int, default=10, help='Number of best single mutants')
+    parser.add_argument('--no-suggested', action='store_true',
+                        help='Do not build the combined suggested mutant')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--chimera', default='chimera', help='Chimera executable')
+    parser.add_argument('--criteria', default='chp')
+    args = parser.parse_args(argv)
+
+    from core import Model
+    model = Model(gui=None)
+    model.parse_files(args.pops, args.pop)
+    jobs = mutant_jobs(model, top=args.top, suggested=not args.no_suggested)
+    for record in run_batch(args.structure, jobs, args.outdir, workers=args.workers,
+                            chimera=args.chimera, criteria=args.criteria):
+        print(record['id'], record['status'], record.get('path', record.get('error')))
+
+
+# Chimera runs --script files in a sandbox module, not as __main__
+if __name__ == '__main__' or __name__.startswith('chimeraOpenSandbox'):
+    main()
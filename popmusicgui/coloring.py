@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Fast residue coloring based on precomputed palette lookup tables (LUT).
+
+Values are mapped to LUT indices with NumPy in a single pass, and each
+LUT entry holds a single, lazily created ``chimera.MaterialColor``, so
+residues sharing a bin also share the same color object.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+# Chimera stuff
+import chimera
+# Additional 3rd parties
+import numpy as np
+
+PALETTES = {
+    'Rainbow': [(0., 0., 1.), (0., 1., 1.), (0., 1., 0.), (1., 1., 0.), (1., 0., 0.)],
+    'Blue-Red': [(0., 0., 1.), (1., 1., 1.), (1., 0., 0.)],
+    'Red-Blue': [(1., 0., 0.), (1., 1., 1.), (0., 0., 1.)],
+    'Green-Red': [(0.133, 0.545, 0.133), (1., 1., 1.), (1., 0., 0.)],
+    'Grayscale': [(0., 0., 0.), (1., 1., 1.)],
+}
+
+_luts = {}
+
+
+class PaletteLUT(object):
+
+    """
+    A lookup table of `size` colors linearly interpolated between the
+    stops of a named palette.
+
+    Parameters
+    ----------
+    name : str
+        Key in `PALETTES`
+    size : int, optional
+        Number of entries in the table
+    """
+
+    def __init__(self, name='Rainbow', size=256):
+        if name not in PALETTES:
+            raise KeyError('Unknown palette {}. Choose one of {}'.format(name, ', '.join(PALETTES)))
+        self.name = name
+        self.size = size
+        stops = np.asarray(PALETTES[name], dtype=float)
+        x, t = np.linspace(0, 1, len(stops)), np.linspace(0, 1, size)
+        self.rgb = np.column_stack([np.interp(t, x, stops[:, i]) for i in range(3)])
+        self._colors = [None] * size
+        self._hex = None
+
+    def indices(self, values, vmin=None, vmax=None):
+        """
+        Map `values` to LUT indices in one vectorized pass.
+
+        Parameters
+        ----------
+        values : array-like of float
+            NaN values are mapped to -1 (no color)
+        vmin, vmax : float, optional
+            Range spanned by the palette. Defaults to the extrema of `values`.
+
+        Returns
+        -------
+        np.ndarray of int
+        """
+        values = np.asarray(values, dtype=float)
+        missing = np.isnan(values)
+        if missing.all():
+            return np.full(values.shape, -1, dtype=int)
+        if vmin is None:
+            vmin = np.nanmin(values)
+        if vmax is None:
+            vmax = np.nanmax(values)
+        span = (vmax - vmin) or 1.
+        scaled = (np.where(missing, vmin, values) - vmin) / span
+        idx = np.clip(np.rint(scaled * (self.size - 1)), 0, self.size - 1).astype(int)
+        idx[missing] = -1
+        return idx
+
+    def color(self, index):
+        """
+        Cached ``chimera.MaterialColor`` for LUT entry `index`
+        """
+        color = self._colors[index]
+        if color is None:
+            color = self._colors[index] = chimera.MaterialColor(*(tuple(self.rgb[index]) + (1.0,)))
+        return color
+
+    @property
+    def hex(self):
+        """
+        Tk-compatible '#rrggbb' strings for each LUT entry
+        """
+        if self._hex is None:
+            rgb = np.rint(self.rgb * 255).astype(int)
+            self._hex = ['#{:02x}{:02x}{:02x}'.format(*c) for c in rgb]
+        return self._hex
+
+    def colors(self, values, vmin=None, vmax=None):
+        """
+        List of cached colors (or None for NaN) for each value.
+        """
+        color = self.color
+        return [color(i) if i >= 0 else None for i in self.indices(values, vmin, vmax)]
+
+
+def get_lut(name='Rainbow', size=256):
+    """
+    Return a shared `PaletteLUT`, building it only the first time.
+    """
+    key = name, size
+    lut = _luts.get(key)
+    if lut is None:
+        lut = _luts[key] = PaletteLUT(name, size)
+    return lut
+
+
+def color_residues(residues, values, palette='Rainbow', vmin=None, vmax=None):
+    """
+    Set the ribbon color of each residue according to its value.
+
+    Parameters
+    ----------
+    residues : list of chimera.Residue
+    values : array-like of float
+        One value per residue, in the same order
+    palette : str, optional
+        Name of the palette in `PALETTES`
+    vmin, vmax : float, optional
+        Range spanned by the palette
+    """
+    colors = get_lut(palette).colors(values, vmin=vmin, vmax=vmax)
+    for residue, color in zip(residues, colors):
+        residue.ribbonColor = color
+
+
+def reset_residues(residues):
+    """
+    Restore the default ribbon color for all residues
+    """
+    for residue in residues:
+        residue.ribbonColor = None
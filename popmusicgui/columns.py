@@ -0,0 +1,578 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Columnar representation of .pop data, with vectorized queries.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+from collections import defaultdict
+import numbers
+import operator
+import re
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+# Additional 3rd parties
+import numpy as np
+
+
+OPERATORS = {
+    'lt': operator.lt, '<': operator.lt,
+    'le': operator.le, '<=': operator.le,
+    'gt': operator.gt, '>': operator.gt,
+    'ge': operator.ge, '>=': operator.ge,
+    'eq': operator.eq, '==': operator.eq, '=': operator.eq,
+    'ne': operator.ne, '!=': operator.ne,
+    'in': None,
+}
+
+ALIASES = {
+    'position': 'id',
+    'wt': 'residue_wildtype',
+    'wildtype': 'residue_wildtype',
+    'mt': 'residue_mutated',
+    'mutant': 'residue_mutated',
+    'mutation': 'residue_mutated',
+    'secondary_structure': 'ss',
+    'solvent_accessibility': 'sa',
+    'ddg': 'ddG',
+}
+
+INDEXED = ('chain', 'ss', 'residue_wildtype')
+
+AMINO_ACIDS = ('ALA', 'ARG', 'ASN', 'ASP', 'CYS', 'GLN', 'GLU', 'GLY', 'HIS', 'ILE',
+               'LEU', 'LYS', 'MET', 'PHE', 'PRO', 'SER', 'THR', 'TRP', 'TYR', 'VAL')
+SECONDARY_STRUCTURES = ('C', 'H', 'E', 'B', 'G', 'I', 'T', 'S')
+
+# Categorical fields stored as uint8 codes, with the values known in advance
+CATEGORIES = {
+    'chain': (),
+    'ss': SECONDARY_STRUCTURES,
+    'secondary_structure': SECONDARY_STRUCTURES,
+    'residue_wildtype': AMINO_ACIDS,
+    'residue_mutated': AMINO_ACIDS,
+    'residue_type': AMINO_ACIDS,
+}
+
+_EMPTY = np.empty(0, dtype=int)
+
+
+class Vocabulary(object):
+
+    """
+    Mapping between up to 256 distinct strings and uint8 codes. The
+    `initial` values get the first codes; others are added as found.
+    """
+
+    __slots__ = ('values', '_codes')
+
+    def __init__(self, initial=()):
+        self.values = []
+        self._codes = {}
+        for value in initial:
+            self.code(value)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, value):
+        return value in self._codes
+
+    def get(self, value):
+        """
+        Code of `value`, or None if it is unknown
+        """
+        return self._codes.get(value)
+
+    def code(self, value):
+        """
+        Code of `value`, adding it if needed
+        """
+        code = self._codes.get(value)
+        if code is None:
+            if len(self.values) > 255:
+                raise ValueError('More than 256 distinct values')
+            code = self._codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def encode(self, values):
+        values = list(values)
+        return np.fromiter((self.code(v) for v in values), dtype=np.uint8, count=len(values))
+
+    def decode(self, codes):
+        """
+        Values of `codes`, as a list of the (shared) string objects
+        """
+        values = self.values
+        return [values[c] for c in np.asarray(codes).tolist()]
+
+
+class MutationColumns(object):
+
+    """
+    Store a sequence of PopTuple-like records as one NumPy array per field,
+    plus precomputed indexes (value -> row indices) for categorical columns.
+
+    Categorical fields (chain, amino acids, secondary structure) are kept
+    as uint8 codes in `codes`, with their `vocabularies`; integers are
+    stored as int32. Indexing by field name returns the decoded values.
+
+    Parameters
+    ----------
+    rows : iterable of namedtuple
+        Records sharing the same fields, like those yielded by `core.parse_pop`
+    record : type, optional
+        Namedtuple class used to rebuild rows. Inferred from `rows` if not set.
+    fields : tuple of str, optional
+        Field names, needed only if `rows` is empty and `record` is not set
+    """
+
+    def __init__(self, rows, record=None, fields=None):
+        rows = list(rows)
+        if record is None and rows:
+            record = type(rows[0])
+        if fields is None:
+            fields = record._fields
+        self.record = record
+        self.fields = tuple(fields)
+        self.size = len(rows)
+        self.codes, self.vocabularies, self.numeric = {}, {}, {}
+        for i, name in enumerate(self.fields):
+            if name in CATEGORIES:
+                vocabulary = self.vocabularies[name] = Vocabulary(CATEGORIES[name])
+                self.codes[name] = vocabulary.encode(r[i] for r in rows)
+                continue
+            column = np.array([r[i] for r in rows])
+            if not rows:
+                column = column.astype(float)
+            elif column.dtype.kind == 'i':
+                column = column.astype(np.int32)
+            self.numeric[name] = column
+        self.indexes = {name: self._build_index(self.codes[name], self.vocabularies[name])
+                        for name in INDEXED if name in self.codes}
+
+    @classmethod
+    def from_arrays(cls, fields, codes, vocabularies, numeric, record=None):
+        """
+        Wrap already encoded arrays (e.g. memory mapped ones) without
+        copying them. No value indexes are built; coded fields are then
+        filtered by comparing codes.
+
+        Parameters
+        ----------
+        fields : tuple of str
+        codes : dict
+            {field: uint8 array} for categorical fields
+        vocabularies : dict
+            {field: list of values}, in code order
+        numeric : dict
+            {field: array} for the rest
+        record : type, optional
+            Namedtuple class used to rebuild rows
+        """
+        self = cls.__new__(cls)
+        self.record = record
+        self.fields = tuple(fields)
+        self.codes, self.numeric = dict(codes), dict(numeric)
+        self.vocabularies = dict((name, Vocabulary(values)) for name, values in vocabularies.items())
+        arrays = list(self.codes.values()) + list(self.numeric.values())
+        self.size = len(arrays[0]) if arrays else 0
+        self.indexes = {}
+        return self
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, name):
+        if name not in self.fields:
+            name = ALIASES.get(name, name)
+        if name in self.codes:
+            return np.array(self.vocabularies[name].decode(self.codes[name]), dtype=str)
+        return self.numeric[name]
+
+    @property
+    def columns(self):
+        """
+        {field: array} with decoded categorical columns
+        """
+        return dict((name, self[name]) for name in self.fields)
+
+    @property
+    def nbytes(self):
+        """
+        Memory held by the column arrays
+        """
+        return sum(a.nbytes for a in list(self.codes.values()) + list(self.numeric.values()))
+
+    @staticmethod
+    def _build_index(codes, vocabulary):
+        """
+        Map each value present in `codes` to the sorted indices where it appears
+        """
+        order = np.argsort(codes, kind='mergesort').astype(np.int32)
+        bounds = np.searchsorted(codes[order], np.arange(len(vocabulary) + 1))
+        return {value: order[bounds[c]:bounds[c+1]] for c, value in enumerate(vocabulary.values)
+                if bounds[c+1] > bounds[c]}
+
+    def residue_rows(self, residues):
+        """
+        Group the rows by residue.
+
+        Parameters
+        ----------
+        residues : list of (chain, id)
+
+        Returns
+        -------
+        order, bounds : np.ndarray of int32
+            The rows of ``residues[i]`` are ``order[bounds[i]:bounds[i + 1]]``,
+            in file order
+        """
+        residue_of = dict((key, i) for i, key in enumerate(residues))
+        owners = np.array([residue_of.get(key, -1) for key in
+                           zip(self['chain'].tolist(), self['id'].tolist())], dtype=np.int32)
+        order = np.argsort(owners, kind='mergesort').astype(np.int32)
+        bounds = np.searchsorted(owners[order], np.arange(len(residues) + 1)).astype(np.int32)
+        return order, bounds
+
+    def mask(self, **criteria):
+        """
+        Boolean mask of the rows satisfying all `criteria`.
+
+        Criteria are given as `field__op=value`, where `op` is one of
+        `lt`, `le`, `gt`, `ge`, `eq` (default) `ne` or `in`. Equality and
+        membership tests over `chain`, `ss` and `residue_wildtype` are
+        resolved through the precomputed indexes, and over other
+        categorical fields by comparing codes.
+
+        Example: ``mask(ddG__lt=-0.5, ss='H', sa__gt=30, chain='B')``
+        """
+        mask = np.ones(self.size, dtype=bool)
+        for key, value in criteria.items():
+            field, _, op = key.partition('__')
+            field, op = field if field in self.fields else ALIASES.get(field, field), op or 'eq'
+            if field not in self.fields:
+                raise KeyError('Unknown field {}'.format(field))
+            if op not in OPERATORS:
+                raise KeyError('Unknown operator {}'.format(op))
+            if op == 'in' and isinstance(value, basestring_):
+                value = [_coerce(v) for v in value.split(',')]
+            values = value if op == 'in' else [value]
+            if field in self.numeric:
+                values = [_coerce(v) if isinstance(v, basestring_) else v for v in values]
+                for v in values:
+                    if not isinstance(v, numbers.Number):
+                        raise ValueError('{} is numeric, cannot compare it with "{}"'.format(field, v))
+                value = values if op == 'in' else values[0]
+            if field in self.indexes and op in ('eq', '==', '=', 'in'):
+                selected = np.zeros(self.size, dtype=bool)
+                for v in values:
+                    selected[self.indexes[field].get(str(v), _EMPTY)] = True
+                mask &= selected
+            elif field in self.codes and op in ('eq', '==', '=', 'in', 'ne', '!='):
+                vocabulary = self.vocabularies[field]
+                lookup = np.zeros(256, dtype=bool)
+                lookup[[vocabulary.get(str(v)) for v in values if str(v) in vocabulary]] = True
+                selected = lookup[self.codes[field]]
+                mask &= ~selected if op in ('ne', '!=') else selected
+            elif op == 'in':
+                mask &= np.isin(self[field], np.array(list(values)).astype(self[field].dtype))
+            else:
+                mask &= OPERATORS[op](self[field], value)
+        return mask
+
+    def query(self, **criteria):
+        """
+        Indices of the rows satisfying all `criteria`. See `mask`.
+        """
+        return np.flatnonzero(self.mask(**criteria))
+
+    def rows(self, indices=None):
+        """
+        Rebuild the records at `indices` (all of them by default)
+        """
+        if indices is None:
+            indices = np.arange(self.size)
+        columns = []
+        for name in self.fields:
+            if name in self.codes:
+                columns.append(self.vocabularies[name].decode(self.codes[name][indices]))
+            else:
+                columns.append(self.numeric[name][indices].tolist())
+        return [self.record(*values) for values in zip(*columns)]
+
+
+class ResidueMutations(Mapping):
+
+    """
+    Read-only {residue_mutated: record(sa, ddG)} view of the mutations of
+    one residue, backed by a `MutationColumns`. Nothing is stored per
+    mutation; records are built on access.
+
+    Parameters
+    ----------
+    columns : MutationColumns
+    rows : np.ndarray of int
+        Rows of the residue in `columns`
+    record : type, optional
+        Built from the (sa, ddG) values of each mutation
+    """
+
+    __slots__ = ('_columns', '_rows', '_record')
+
+    def __init__(self, columns, rows, record=tuple):
+        self._columns = columns
+        self._rows = rows
+        self._record = record
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __iter__(self):
+        return iter(self._types())
+
+    def __getitem__(self, new_type):
+        code = self._columns.vocabularies['residue_mutated'].get(new_type)
+        if code is not None:
+            found = np.flatnonzero(self._columns.codes['residue_mutated'][self._rows] == code)
+            if len(found):
+                row = self._rows[found[0]]
+                numeric = self._columns.numeric
+                return self._record(float(numeric['sa'][row]), float(numeric['ddG'][row]))
+        raise KeyError(new_type)
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, dict(self.items()))
+
+    def _types(self):
+        columns = self._columns
+        return columns.vocabularies['residue_mutated'].decode(columns.codes['residue_mutated'][self._rows])
+
+    def items(self):
+        numeric = self._columns.numeric
+        values = zip(numeric['sa'][self._rows].tolist(), numeric['ddG'][self._rows].tolist())
+        return [(t, self._record(*v)) for t, v in zip(self._types(), values)]
+
+    def values(self):
+        return [v for _, v in self.items()]
+
+    def iteritems(self):  # Python 2 dict interface
+        return iter(self.items())
+
+
+class RankIndex(object):
+
+    """
+    Ordering of a numeric column computed once, so that the K smallest or
+    largest rows can be retrieved by slicing, without comparisons.
+    NaN values are left out of the ranking.
+
+    Parameters
+    ----------
+    values : np.ndarray of float
+    """
+
+    def __init__(self, values):
+        values = np.asarray(values, dtype=float)
+        finite = np.flatnonzero(~np.isnan(values))
+        self.order = finite[np.argsort(values[finite], kind='mergesort')].astype(np.int32)
+
+    def __len__(self):
+        return len(self.order)
+
+    def smallest(self, k):
+        """
+        Indices of the `k` rows with the lowest values, in ascending order
+        """
+        return self.order[:max(k, 0)]
+
+    def largest(self, k):
+        """
+        Indices of the `k` rows with the highest values, in descending order
+        """
+        return self.order[::-1][:max(k, 0)]
+
+
+class SortOrders(object):
+
+    """
+    Stable argsort permutation of some numeric fields of a list of records,
+    computed once so that sorted views of the records are plain reindexing.
+    NaN values sort last.
+
+    Parameters
+    ----------
+    rows : list of namedtuple
+    fields : list of str
+        Names of the numeric fields to index
+    """
+
+    def __init__(self, rows, fields):
+        self.orders = {}
+        for field in fields:
+            values = np.fromiter((getattr(row, field) for row in rows), dtype=float, count=len(rows))
+            self.orders[field] = np.argsort(values, kind='mergesort')
+
+    def __contains__(self, field):
+        return field in self.orders
+
+    def permutation(self, field, descending=False):
+        """
+        Row indices sorted by `field`
+        """
+        order = self.orders[field]
+        return order[::-1] if descending else order
+
+    def sorted(self, items, field, descending=False):
+        """
+        `items` (aligned with the indexed rows) sorted by `field`
+        """
+        return [items[i] for i in self.permutation(field, descending).tolist()]
+
+
+class ResidueIndex(object):
+
+    """
+    Incremental search over residue keys. Every prefix of the position
+    (``123``), chain (``A``), residue type (``ASP``) and position.chain
+    (``123.A``) of each residue is indexed, so that each typed word costs
+    a single dictionary lookup. Case insensitive.
+
+    Parameters
+    ----------
+    keys : list of (chain, position, residue_type)
+    """
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+        prefixes, positions = defaultdict(set), defaultdict(list)
+        for i, (chain, position, residue_type) in enumerate(self.keys):
+            positions[str(position)].append(i)
+            for token in (str(position), chain, residue_type, '{}.{}'.format(position, chain)):
+                token = token.lower()
+                for n in range(1, len(token) + 1):
+                    prefixes[token[:n]].add(i)
+        self._prefixes = dict((k, np.array(sorted(v), dtype=int)) for k, v in prefixes.items())
+        self._positions = dict((k, np.array(v, dtype=int)) for k, v in positions.items())
+
+    def search(self, text):
+        """
+        Indices of the keys matching every word of `text`. Residues whose
+        position is exactly a typed number come first.
+
+        Returns
+        -------
+        np.ndarray of int
+        """
+        words = text.lower().replace(':', ' ').split()
+        empty = np.empty(0, dtype=int)
+        if not words:
+            return empty
+        hits = None
+        for word in words:
+            found = self._prefixes.get(word, empty)
+            hits = found if hits is None else np.intersect1d(hits, found, assume_unique=True)
+        exact = [self._positions[w] for w in words if w in self._positions]
+        if exact and len(hits):
+            first = np.intersect1d(hits, np.concatenate(exact))
+            hits = np.concatenate([first, np.setdiff1d(hits, first, assume_unique=True)])
+        return hits
+
+
+class DDGMatrix(object):
+
+    """
+    Dense residue x amino acid representation of a saturation scan.
+
+    Parameters
+    ----------
+    mutations : MutationColumns
+        Parsed .pop data
+    residues : list of (chain, id), optional
+        Row order. Defaults to the order of first appearance in `mutations`.
+    field : str, optional
+        Column of `mutations` to store in the matrix
+
+    Attributes
+    ----------
+    values : np.ndarray of float32, shape (len(residues), len(AMINO_ACIDS))
+        NaN marks missing mutations (including the wild type itself)
+    """
+
+    def __init__(self, mutations, residues=None, field='ddG'):
+        chains, ids = mutations['chain'], mutations['id']
+        if residues is None:
+            seen = {}
+            for key in zip(chains.tolist(), ids.tolist()):
+                seen.setdefault(key, len(seen))
+            residues = sorted(seen, key=seen.get)
+        self.residues = list(residues)
+        self.amino_acids = AMINO_ACIDS
+        self.values = np.full((len(self.residues), len(AMINO_ACIDS)), np.nan, dtype=np.float32)
+        row_of = {key: i for i, key in enumerate(self.residues)}
+        col_of = {aa: j for j, aa in enumerate(AMINO_ACIDS)}
+        rows = np.array([row_of.get(key, -1) for key in zip(chains.tolist(), ids.tolist())], dtype=int)
+        cols = np.array([col_of.get(aa, -1) for aa in mutations['residue_mutated'].tolist()], dtype=int)
+        valid = (rows >= 0) & (cols >= 0)
+        self.values[rows[valid], cols[valid]] = mutations[field][valid]
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def cell(self, i, j):
+        """
+        Return ((chain, id), amino_acid, value) for cell at row `i` and column `j`
+        """
+        return self.residues[i], self.amino_acids[j], float(self.values[i, j])
+
+
+def parse_query(text):
+    """
+    Parse a textual query like ``ddG < -0.5 and ss == H and chain in A,B``
+    into criteria suitable for `MutationColumns.mask`.
+
+    Returns
+    -------
+    dict
+    """
+    criteria = {}
+    for clause in _CONJUNCTION.split(text):
+        clause = clause.strip()
+        if not clause:
+            continue
+        tokens = clause.split(None, 2)
+        if len(tokens) != 3 or tokens[1] not in OPERATORS:
+            raise ValueError('Cannot understand query clause "{}"'.format(clause))
+        field, op, value = tokens
+        field = ALIASES.get(field, field)
+        if op == 'in':
+            value = [_coerce(v) for v in value.split(',')]
+        else:
+            value = _coerce(value)
+        op = {'<': 'lt', '<=': 'le', '>': 'gt', '>=': 'ge',
+              '==': 'eq', '=': 'eq', '!=': 'ne'}.get(op, op)
+        criteria['{}__{}'.format(field, op)] = value
+    return criteria
+
+
+_CONJUNCTION = re.compile(r'\s+and\s+|&', re.IGNORECASE)
+
+
+def _coerce(value):
+    value = value.strip().strip('"\'')
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+try:
+    basestring_ = basestring
+except NameError:  # Python 3
+    basestring_ = str
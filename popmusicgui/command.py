@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Implementation of the `popmusic` Chimera command, which exposes the
+results handling to the command line and scripts without building any dialog.
+
+Usage::
+
+    popmusic load pops pop [spec #0] [attributes true] [defattr false] [merge false]
+    popmusic attributes [defattr false] [spec #0]
+    popmusic color [field ddG] [palette Rainbow] [vmin x] [vmax y] [spec #0]
+    popmusic uncolor [spec #0]
+    popmusic label [field ddG] [spec #0]
+    popmusic unlabel [spec #0]
+    popmusic apply [top n] [criteria chp] [spec #0]
+    popmusic undo|redo [spec #0]
+    popmusic export path [format parquet|feather|npz] [spec #0]
+    popmusic close [spec #0]
+
+Actions can be abbreviated to any unique prefix. Without `spec`, `load`
+needs a single open molecule and the rest act on every loaded one.
+"""
+
+from __future__ import print_function, division
+# Chimera stuff
+import chimera
+from chimera import UserError, replyobj
+# Own
+from core import Controller, Model
+
+# Headless controllers, one per molecule
+_controllers = {}
+
+
+def popmusic(cmdName, args):
+    """
+    Entry point registered with `Midas.midas_text.addCommand`
+    """
+    from Midas.midas_text import doExtensionFunc
+    fields = args.split(None, 1)
+    if not fields:
+        raise UserError('Usage: popmusic {} ...'.format('|'.join(sorted(ACTIONS))))
+    action, rest = fields[0], fields[1] if len(fields) > 1 else ''
+    matches = [name for name in ACTIONS if name.startswith(action)]
+    if action in ACTIONS:
+        matches = [action]
+    if len(matches) != 1:
+        raise UserError('Unknown or ambiguous popmusic action: {}'.format(action))
+    doExtensionFunc(ACTIONS[matches[0]], rest, specInfo=[('spec', 'molecules', 'molecules')])
+
+
+def controllers(molecules=None):
+    """
+    Headless controllers of `molecules`, or of every loaded molecule
+    """
+    for molecule in [m for m in _controllers if m.__destroyed__]:
+        del _controllers[molecule]
+    if molecules is None:
+        found = list(_controllers.values())
+    else:
+        found = [_controllers[m] for m in molecules if m in _controllers]
+    if not found:
+        raise UserError('No PoPMuSiC results loaded. Use "popmusic load" first.')
+    return found
+
+
+def load(pops, pop, molecules=None, attributes=True, defattr=False, merge=False):
+    """
+    Parse a .pops/.pop pair and bind it to a molecule
+    """
+    if molecules is None:
+        molecules = chimera.openModels.list(modelTypes=[chimera.Molecule])
+    if len(molecules) != 1:
+        raise UserError('Specify exactly one molecule to load the results onto')
+    molecule = molecules[0]
+    model = Model(gui=None, cache=Controller.content_cache)
+    controller = Controller(None, model, molecule=molecule)
+    # Identical structure and results already loaded (under any name) are reused
+    model.parse_files(pops, pop, merge_chains=merge, structure=controller.structure_hash())
+    _controllers[molecule] = controller
+    Controller.results[molecule] = model.residues
+    if attributes:
+        controller.set_attributes(defattr=defattr)
+    replyobj.status('Loaded {} PoPMuSiC residues onto {}'.format(len(model.residues), molecule.name))
+    return controller
+
+
+def attributes(molecules=None, defattr=False):
+    for controller in controllers(molecules):
+        controller.set_attributes(defattr=defattr)
+
+
+def color(field='ddG', palette='Rainbow', vmin=None, vmax=None, molecules=None):
+    for controller in controllers(molecules):
+        controller.color_by(field, palette=palette, vmin=vmin, vmax=vmax)
+
+
+def uncolor(molecules=None):
+    for controller in controllers(molecules):
+        controller.reset_colors()
+
+
+def label(field='ddG', molecules=None):
+    for controller in controllers(molecules):
+        controller.render_labels(field)
+
+
+def unlabel(molecules=None):
+    for controller in controllers(molecules):
+        controller.clear_labels()
+
+
+def apply(top=None, criteria='chp', molecules=None):
+    """
+    Apply the best mutation of every favourable residue or, with `top`,
+    the `top` most stabilizing mutations (best one per residue).
+    """
+    for controller in controllers(molecules):
+        if top is None:
+            controller.apply_favourable_mutations(criteria=criteria)
+        else:
+            controller.apply_mutations(controller.model.top_mutations(int(top)), criteria=criteria)
+
+
+def undo(molecules=None):
+    for controller in controllers(molecules):
+        controller.undo()
+
+
+def redo(molecules=None):
+    for controller in controllers(molecules):
+        controller.redo()
+
+
+def export(path, format=None, molecules=None):
+    import export as export_
+    found = controllers(molecules)
+    if len(found) > 1:
+        raise UserError('Results loaded on several molecules. Choose one with spec.')
+    return export_.export(found[0].model, path, format=format)
+
+
+def close(molecules=None):
+    for controller in controllers(molecules):
+        _controllers.pop(controller.molecule, None)
+        Controller.results.pop(controller.molecule, None)
+
+
+ACTIONS = {
+    'load': load,
+    'attributes': attributes,
+    'color': color,
+    'uncolor': uncolor,
+    'label': label,
+    'unlabel': unlabel,
+    'apply': apply,
+    'undo': undo,
+    'redo': redo,
+    'export': export,
+    'close': close,
+}
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Align several PoPMuSiC runs of the same structure and compute ddG deltas.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import os
+import re
+# Additional 3rd parties
+import numpy as np
+# Own
+from core import parse_header
+
+
+class RunComparison(object):
+
+    """
+    Several parsed models aligned by (chain, id, mutant) for mutations and
+    by (chain, id) for residues. Keys missing in a run are NaN.
+
+    Parameters
+    ----------
+    models : list of core.Model
+        Parsed models. The first one is the reference for deltas.
+    labels : list of str, optional
+        Name of each run. Used to prefix residue attributes.
+
+    Attributes
+    ----------
+    keys : list of (chain, id, mutant)
+    ddG, delta : np.ndarray, shape (len(keys), len(models))
+        ddG of each mutation in each run, and its difference with the reference
+    residue_keys : list of (chain, id)
+    residue_ddG, residue_delta : np.ndarray, shape (len(residue_keys), len(models))
+    """
+
+    def __init__(self, models, labels=None):
+        if len(models) < 2:
+            raise ValueError('At least two runs are needed for a comparison')
+        if labels is None:
+            labels = ['run{}'.format(i) for i in range(len(models))]
+        self.labels = []
+        for label in labels:
+            label = attribute_label(label)
+            while label in self.labels:
+                label += '_'
+            self.labels.append(label)
+        self.keys, self.ddG = align(
+            [zip(m.mutations['chain'].tolist(), m.mutations['id'].tolist(),
+                 m.mutations['residue_mutated'].tolist()) for m in models],
+            [m.mutations['ddG'] for m in models])
+        self.residue_keys, self.residue_ddG = align(
+            [[(r.chain, r.id) for r in m.residues] for m in models],
+            [np.array([r.ddG for r in m.residues], dtype=float) for m in models])
+        self.delta = self.ddG - self.ddG[:, :1]
+        self.residue_delta = self.residue_ddG - self.residue_ddG[:, :1]
+
+    def rows(self, run=1):
+        """
+        (chain, id, mutant, reference ddG, run ddG, delta) for each aligned mutation
+        """
+        return [key + (ref, value, delta) for key, ref, value, delta
+                in zip(self.keys, self.ddG[:, 0].tolist(), self.ddG[:, run].tolist(),
+                       self.delta[:, run].tolist())]
+
+    def residue_attributes(self):
+        """
+        Per-residue attributes, named with a run-specific prefix
+
+        Yields
+        ------
+        (chain, id), name, value
+        """
+        for j, label in enumerate(self.labels):
+            for key, ddg, delta in zip(self.residue_keys, self.residue_ddG[:, j].tolist(),
+                                       self.residue_delta[:, j].tolist()):
+                if ddg == ddg:  # skip NaN
+                    yield key, 'popmusic_{}_ddG'.format(label), ddg
+                    if j:
+                        yield key, 'popmusic_{}_delta_ddG'.format(label), delta
+
+
+def align(key_lists, value_arrays):
+    """
+    Hash-join several (keys, values) columns into a single matrix.
+
+    Parameters
+    ----------
+    key_lists : list of iterables of hashable
+    value_arrays : list of np.ndarray
+        One value per key, for each run
+
+    Returns
+    -------
+    keys : list
+        Union of all keys, in order of first appearance
+    matrix : np.ndarray of float, shape (len(keys), len(key_lists))
+    """
+    index, positions = {}, []
+    for keys in key_lists:
+        positions.append(np.array([index.setdefault(k, len(index)) for k in keys], dtype=int))
+    matrix = np.full((len(index), len(key_lists)), np.nan)
+    for j, (pos, values) in enumerate(zip(positions, value_arrays)):
+        matrix[pos, j] = values
+    return sorted(index, key=index.get), matrix
+
+
+def attribute_label(label):
+    """
+    Turn `label` into something usable in a Chimera attribute name
+    """
+    return re.sub(r'\W+', '_', label).strip('_') or 'run'
+
+
+def run_label(pops):
+    """
+    Default label of a run: file name plus considered chains, if not ALL
+    """
+    label = os.path.splitext(os.path.basename(pops))[0]
+    chains = parse_header(pops).get('Chains considered', 'ALL')
+    if chains.upper() != 'ALL':
+        label += '_' + chains
+    return attribute_label(label)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Content hashing of structures and result sets, plus a shared cache of
+whatever is derived from them (parsed models, run comparisons, contact
+graphs), so identical inputs loaded under other file names or chain
+orders are not processed again.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+from collections import OrderedDict
+import hashlib
+# Additional 3rd parties
+import numpy as np
+# Own
+from spatial import atom_coordinates
+
+
+def file_hash(f, sha=None, chunk_size=1 << 16):
+    """
+    SHA1 of the contents of `f`, a path or a binary file-like object.
+    If `sha` is given, it is updated in place and returned.
+    """
+    if sha is None:
+        sha = hashlib.sha1()
+    if not hasattr(f, 'read'):
+        with open(f, 'rb') as opened:
+            return file_hash(opened, sha, chunk_size)
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+        sha.update(chunk)
+    return sha
+
+
+def results_hash(pops, pop, opener=open):
+    """
+    Hash of the contents of a .pops/.pop pair, regardless of file names.
+
+    Parameters
+    ----------
+    pops, pop : str
+        Paths to .pops and .pop files
+    opener : callable, optional
+        Returns a binary file-like object for a path. Use
+        `core.open_results` so that compressed and plain copies of the
+        same results hash alike.
+
+    Returns
+    -------
+    str
+    """
+    digests = []
+    for path in (pops, pop):
+        with opener(path) as f:
+            digests.append(file_hash(f).hexdigest())
+    return combine_hashes(digests)
+
+
+def combine_hashes(digests):
+    """
+    Hash of a sequence of hex digests, like those of the files of a
+    result set (.pops first). Lets callers hash each file as they read it.
+    """
+    return hashlib.sha1(' '.join(digests).encode('ascii')).hexdigest()
+
+
+def chain_hashes(residues, decimals=2):
+    """
+    One hash per chain of `residues`, made of its sequence and the
+    coordinates of its atoms rounded to `decimals`. Atoms are taken in
+    name order, so their order in the file does not matter.
+
+    Returns
+    -------
+    list of (chain, str)
+        In order of first appearance
+    """
+    residues = list(residues)
+    atoms = [sorted(r.atoms, key=lambda a: a.name) for r in residues]
+    coordinates = np.round(atom_coordinates([a for group in atoms for a in group]), decimals)
+    coordinates += 0.0  # -0.0 and 0.0 must hash alike
+    chains, start = OrderedDict(), 0
+    for residue, group in zip(residues, atoms):
+        stop = start + len(group)
+        sha = chains.get(residue.id.chainId)
+        if sha is None:
+            sha = chains[residue.id.chainId] = hashlib.sha1(residue.id.chainId.encode('utf-8'))
+        sha.update('{}{}:{};'.format(residue.id.position, residue.id.insertionCode,
+                                     residue.type).encode('utf-8'))
+        sha.update(' '.join(a.name for a in group).encode('utf-8'))
+        sha.update(np.ascontiguousarray(coordinates[start:stop]).tobytes())
+        start = stop
+    return [(chain, sha.hexdigest()) for chain, sha in chains.items()]
+
+
+def molecule_hash(molecule, decimals=2, ordered=False):
+    """
+    Hash of the contents of `molecule`. See `chain_hashes`.
+
+    Parameters
+    ----------
+    molecule : chimera.Molecule
+    decimals : int, optional
+        Coordinates are rounded to this many decimals before hashing
+    ordered : bool, optional
+        If False (default), the order of the chains in the file is
+        ignored. Set it when the hash keys data that depends on the
+        residue order, like residue indices.
+
+    Returns
+    -------
+    str
+    """
+    hashes = chain_hashes(molecule.residues, decimals=decimals)
+    if not ordered:
+        hashes.sort()
+    return hashlib.sha1(''.join(h for _, h in hashes).encode('ascii')).hexdigest()
+
+
+def canonical_order(residues):
+    """
+    Indices of `residues` sorted by (chain, position, insertion code). It
+    is the same residue order for all molecules with the same
+    `molecule_hash`, whatever the order of their chains in the file.
+    """
+    keys = [(r.id.chainId, r.id.position, r.id.insertionCode) for r in residues]
+    return sorted(range(len(keys)), key=keys.__getitem__)
+
+
+class ContentCache(object):
+
+    """
+    Least recently used cache of objects derived from content hashes.
+    Keys are tuples starting with the kind of object, like
+    ``('model', structure_hash, results_hash, merge_chains)``.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Number of entries kept of each kind
+    """
+
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        if key not in self._entries:
+            return default
+        value = self._entries[key] = self._entries.pop(key)  # Mark as recently used
+        return value
+
+    def put(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        same_kind = [k for k in self._entries if k[0] == key[0]]
+        for old in same_kind[:max(0, len(same_kind) - self.maxsize)]:  # Least recently used first
+            del self._entries[old]
+
+    def get_or_build(self, key, factory):
+        """
+        Cached value of `key`, or the result of `factory()`, which is then
+        cached. Keys containing None are not cached.
+        """
+        if None in key:
+            return factory()
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.put(key, value)
+        return value
+
+    def clear(self, kind=None):
+        """
+        Forget every entry, or only those of `kind`
+        """
+        if kind is None:
+            self._entries.clear()
+        for key in [k for k in self._entries if k[0] == kind]:
+            del self._entries[key]
@@ -6,21 +6,57 @@
 from __future__ import print_function, division 
 # Python stdlib
 from collections import namedtuple
-import os
+import bz2
 import contextlib
+import gzip
+import hashlib
+import io
+import os
+import sqlite3
+try:
+    intern
+except NameError:  # Python 3
+    from sys import intern
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 # Chimera stuff
+import chimera
 from Rotamers import useBestRotamers
 from chimera import UserError
+# Additional 3rd parties
+import numpy as np
 # Own
-import gui
+import coloring
+import defattr
+import spatial
+from history import MutationHistory
+from rotamer_cache import RotamerCache, restore as restore_rotamer
+from symmetry import ChainMap
+from columns import DDGMatrix, MutationColumns, RankIndex, ResidueMutations, SortOrders, parse_query
+from content import ContentCache, canonical_order, combine_hashes, molecule_hash
 
 class Controller(object):
 
     results = {}
-    def __init__(self, gui, model, *args, **kwargs):
+    rotamer_cache = RotamerCache()
+    content_cache = ContentCache()
+    def __init__(self, gui, model, molecule=None, *args, **kwargs):
         self.gui = gui
         self.model = model
-        self.set_mvc()
+        self._molecule = molecule
+        self._database = None
+        self._watch_job = None
+        self._contact_graphs = {}
+        self._structure_hashes = {}
+        self.history = MutationHistory()
+        self.dialog = None
+        if gui is not None:
+            self.set_mvc()
 
     def set_mvc(self):
         # Tie model and gui
@@ -31,25 +67,115 @@ class Controller(object):
                 var.trace(lambda *args: setattr(self.model, name, var.get()))
         # Buttons callbacks
         self.gui.buttonWidgets['Run'].configure(command=self.run)
+        # The database is only opened once the stored runs are needed
+        with ignored(AttributeError):
+            self.gui.ui_store_btn.configure(command=self.store_run)
+            self.gui.ui_stored_runs['menu'].configure(postcommand=self.refresh_stored_runs)
+
+    @property
+    def database(self):
+        """
+        Local results database, opened on first access
+        """
+        if self._database is None:
+            import database
+            with database_errors():
+                self._database = database.ResultsDatabase()
+        return self._database
+
+    def refresh_stored_runs(self):
+        """
+        Fill the stored runs menu with the contents of the database
+        """
+        with database_errors():
+            self.gui.set_stored_runs(self.database.runs())
+
+    def store_run(self):
+        """
+        Import the current .pops/.pop pair into the results database
+        """
+        pops, pop = self.model.popsfile, self.model.popfile
+        if not (pops and pop):
+            raise UserError('Select .pop and .pops files first')
+        structure = self.molecule.name if self.molecule else None
+        with database_errors():
+            self.database.import_files(pops, pop, structure=structure)
+        self.refresh_stored_runs()
 
     def run(self):
-        
-        self.results[self.molecule] = results = self.model.parse()
+        merge_chains = self.gui._merge_chains.get()
+        if self.gui._use_stored.get() and self.gui.stored_run_id is not None:
+            with database_errors():
+                results = self.model.load_stored(self.database, self.gui.stored_run_id,
+                                                 merge_chains=merge_chains)
+        else:
+            results = self.model.parse(merge_chains=merge_chains, structure=self.structure_hash())
+        self.results[self.molecule] = results
         # try:
         #     self.check()
         # except ValueError as e:
         #     raise UserError(str(e))
         #     return
         # else:
-        self.set_attributes()
-        dialog = gui.PoPMuSiCResultsDialog(master=self.gui.uiMaster(), molecule=self.molecule,
-                                           controller=self)
+        self.set_attributes(defattr=self.gui._use_defattr.get())
+        import gui  # Tk dialogs are not needed (nor wanted) by headless users of this module
+        self.dialog = dialog = gui.PoPMuSiCResultsDialog(master=self.gui.uiMaster(),
+                                                         molecule=self.molecule, controller=self)
         dialog.enter()
         dialog.fillInData(results)
 
+    def watch(self, interval=2000):
+        """
+        Poll the loaded files every `interval` ms and apply any changes
+        to residue attributes and the results dialog.
+        """
+        self.unwatch()
+        def poll():
+            # Schedule first: files being regenerated may be missing or half written
+            self._watch_job = self.gui.uiMaster().after(interval, poll)
+            try:
+                self.reload()
+            except (EnvironmentError, ValueError) as e:
+                chimera.replyobj.warning('Could not reload PoPMuSiC results, retrying: {}\n'.format(e))
+        self._watch_job = self.gui.uiMaster().after(interval, poll)
+
+    def unwatch(self):
+        if self._watch_job is not None:
+            self.gui.uiMaster().after_cancel(self._watch_job)
+            self._watch_job = None
+
+    def reload(self):
+        """
+        Reload the model if files changed on disk, updating only what changed.
+        """
+        diff = self.model.reload()
+        if diff is None:
+            return
+        self.results[self.molecule] = self.model.residues
+        self.set_attributes(keys=diff.added + diff.changed)
+        if self.dialog is not None:
+            self.dialog.apply_diff(self.model.residues, diff)
+        return diff
+
     @property
     def molecule(self):
+        if self._molecule is not None or self.gui is None:
+            return self._molecule
         return self.gui.ui_molecules.getvalue()
+
+    def structure_hash(self):
+        """
+        Content hash of the selected molecule, whatever its file name and
+        chain order (see `content.molecule_hash`), or None without molecule.
+        Computed once per molecule until mutations are applied.
+        """
+        molecule = self.molecule
+        if molecule is None:
+            return None
+        digest = self._structure_hashes.get(molecule)
+        if digest is None:
+            digest = self._structure_hashes[molecule] = molecule_hash(molecule)
+        return digest
     
     def check(self):
         """
@@ -68,16 +194,158 @@ class Controller(object):
             raise ValueError("Sequences do not match. Wrong molecule?")
         return True
 
-    def set_attributes(self):
+    def set_attributes(self, keys=None, defattr=False):
         """
         Copy PoPMuSiC data into each residue attributes. They will be
         prefixed with 'popmusic_'.
+
+        Parameters
+        ----------
+        keys : list of (chain, id), optional
+            Only update these residues. All of them by default.
+        defattr : bool, optional
+            Write (or reuse cached) defattr files next to the results and
+            load them with Chimera's reader, instead of setting each attribute
+            from Python. Only used when updating all residues of a model
+            whose identical chains were not merged.
         """
-        for res, row in zip(self.molecule.residues, self.model.residues):
+        if defattr and keys is None and self.model._files is not None and not self.model.chain_map:
+            return self.load_defattr()
+        residues = self.model.broadcast()
+        if keys is None:
+            pairs = zip(self.molecule.residues, residues)
+        else:
+            if self.model.chain_map:
+                keys = [k for key in keys for k in self.model.chain_map.equivalents(key)]
+            rows = {(r.chain, r.id): r for r in residues}
+            pairs = [(self.find_residue(*key), rows[key]) for key in keys]
+        for res, row in pairs:
+            if res is None:
+                continue
             for name, value in zip(row._fields, row):
                 if isinstance(value, float):
                     setattr(res, 'popmusic_' + name, value)
 
+    def load_defattr(self, directory=None):
+        """
+        Load all 'popmusic_' attributes through defattr files, writing them
+        first unless an up-to-date copy is already cached.
+
+        Parameters
+        ----------
+        directory : str, optional
+            Where to look for and write the files. Next to the .pops file by default.
+        """
+        pops, pop = self.model._files
+        paths = defattr.cache_paths(pops, directory=directory)
+        if not defattr.is_fresh(paths.values(), (pops, pop)):
+            try:
+                defattr.write_defattr(self.model.residues, paths)
+            except EnvironmentError as e:
+                raise UserError('Could not write defattr files: {}'.format(e))
+        defattr.load_defattr(paths.values(), self.molecule)
+        return paths
+
+    def compare_with(self, runs, labels=None):
+        """
+        Compare the current run with other runs of the same structure and
+        store the results as residue attributes with run-specific prefixes
+        (`popmusic_<label>_ddG` and `popmusic_<label>_delta_ddG`).
+
+        Parameters
+        ----------
+        runs : list of (pops, pop)
+            Paths of the other runs
+        labels : list of str, optional
+            One label per run in `runs`. Derived from file names and chains by default.
+
+        Returns
+        -------
+        compare.RunComparison
+        """
+        import compare
+        structure, merge_chains = self.structure_hash(), self.model.merge_chains
+        models = [self.model]
+        for pops, pop in runs:
+            # Merged like the current run, so that rows of the same residues are compared
+            model = Model(gui=None, cache=self.content_cache)
+            model.parse_files(pops, pop, merge_chains=merge_chains, structure=structure)
+            models.append(model)
+        if labels is None:
+            labels = [compare.run_label(pops) for pops, _ in runs]
+        current = compare.run_label(self.model._files[0]) if self.model._files else 'current'
+        labels = [current] + list(labels)
+        hashes = tuple(model.content_hash for model in models)
+        key = 'comparison', structure, None if None in hashes else hashes, tuple(labels), merge_chains
+        comparison = self.content_cache.get_or_build(
+            key, lambda: compare.RunComparison(models, labels=labels))
+        chain_map, residues = self.model.chain_map, {}
+        for key, name, value in comparison.residue_attributes():
+            if key not in residues:
+                keys = chain_map.equivalents(key) if chain_map else [key]
+                residues[key] = [r for r in (self.find_residue(*k) for k in keys) if r is not None]
+            for residue in residues[key]:
+                setattr(residue, name, value)
+        return comparison
+
+    def find_hotspots(self, radius=8.0, threshold=0.0, stabilizing=True, mode='CA'):
+        """
+        Group spatially adjacent stabilizing (or destabilizing) positions.
+
+        Parameters
+        ----------
+        radius : float, optional
+            Maximum distance (A) between two residues of the same cluster
+        threshold : float, optional
+            ddG cutoff. With `stabilizing`, candidates have a best mutation
+            ddG below it; otherwise, an average ddG above it.
+        stabilizing : bool, optional
+            Look for stabilizing or destabilizing hotspots
+        mode : str, optional
+            Residue position used: 'CA' or side chain 'centroid'
+
+        Returns
+        -------
+        list of Hotspot
+            Largest clusters first
+        """
+        rows = self.model.residues
+        if stabilizing:
+            values = self.model.matrix.values
+            empty = np.isnan(values).all(axis=1)
+            scores = np.where(empty, np.inf, np.nanmin(np.where(empty[:, None], 0, values), axis=1))
+            candidates = np.flatnonzero(scores < threshold)
+        else:
+            scores = np.array([r.ddG for r in rows], dtype=float)
+            candidates = np.flatnonzero(scores > threshold)
+        # With merged chains, rows are those of reference chains: every copy is a candidate
+        chain_map, keys, indices = self.model.chain_map, [], []
+        for i in candidates:
+            key = rows[i].chain, rows[i].id
+            for k in (chain_map.equivalents(key) if chain_map else [key]):
+                keys.append(k)
+                indices.append(i)
+        indices = np.array(indices, dtype=int)
+        residues = [self.find_residue(*key) for key in keys]
+        coords = spatial.residue_coordinates(residues, mode=mode)
+        hotspots = []
+        for members in spatial.cluster(coords, radius):
+            hotspots.append(Hotspot([keys[j] for j in members], float(scores[indices[members]].sum())))
+        return hotspots
+
+    def color_hotspots(self, hotspots, palette='Rainbow'):
+        """
+        Color each hotspot cluster with a different color of `palette`
+        """
+        residues, values = [], []
+        for i, hotspot in enumerate(hotspots):
+            for key in hotspot.residues:
+                residues.append(self.find_residue(*key))
+                values.append(i)
+        pairs = [(r, v) for r, v in zip(residues, values) if r is not None]
+        coloring.color_residues([r for r, _ in pairs], [v for _, v in pairs], palette=palette,
+                                vmin=0, vmax=max(len(hotspots) - 1, 1))
+
     def render_labels(self, field='ddG', color=None):
         """
         Add labels to each residue in molecule
@@ -90,10 +358,35 @@ class Controller(object):
         color : chimera.Color, optional
             Color of the label text
         """
-        for res, row in zip(self.molecule.residues, self.model.residues):
-            res.label = str(getattr(row, 'popmusic_' + field, ''))
+        for res, row in zip(self.molecule.residues, self.model.broadcast()):
+            res.label = str(getattr(row, field, ''))
             res.labelColor = color
 
+    def color_by(self, field='ddG', palette='Rainbow', vmin=None, vmax=None):
+        """
+        Color residue ribbons by a PoPMuSiC field using a precomputed palette LUT
+
+        Parameters
+        ----------
+        field : str, optional
+            Name of the NamedResidue float field to map to colors
+        palette : str, optional
+            One of `coloring.PALETTES`
+        vmin, vmax : float, optional
+            Range spanned by the palette. Defaults to the extrema of the data.
+        """
+        residues = self.model.broadcast()
+        values = np.fromiter((getattr(row, field) for row in residues), dtype=float,
+                             count=len(residues))
+        coloring.color_residues(self.molecule.residues, values, palette=palette,
+                                vmin=vmin, vmax=vmax)
+
+    def reset_colors(self):
+        """
+        Restore default ribbon colors in molecule
+        """
+        coloring.reset_residues(self.molecule.residues)
+
     def clear_labels(self):
         """
         Remove all existing labels in molecule
@@ -101,7 +394,7 @@ class Controller(object):
         for res in self.molecule.residues:
             res.label, res.labelColor = '', None
 
-    def apply_favourable_mutations(self, conservative=True):
+    def apply_favourable_mutations(self, conservative=True, criteria='chp'):
         """
         Find most favourable mutations in model and apply them. 
 
@@ -109,25 +402,137 @@ class Controller(object):
         ----------
         conservative: bool, optional
             Only those with an overall negative ddG will be candidates.
+        criteria : str, optional
+            Rotamer criteria. See `apply_mutation`.
         """
         candidates = self.model.residues
         if conservative:
             candidates = [r for r in self.model.residues if (r.negative_score + r.positive_score) < 0]
 
+        mutations = []
         for c in candidates:
-            new_type, values = min(c.mutations.iteritems(), key=lambda kv: kv[1].ddG)
+            new_type, values = min(c.mutations.items(), key=lambda kv: kv[1].ddG)
             if values.ddG < 0:
-                residue = self.molecule.findResidue(c.id)
-                self.apply_mutation(residue, new_type)
+                mutations.append(PopTuple(c.chain, c.id, c.residue_type, new_type,
+                                          c.secondary_structure, values.solvent_accessibility,
+                                          values.ddG))
+        self.apply_mutations(mutations, criteria=criteria)
 
-    @staticmethod
-    def apply_mutation(residue, new_type, criteria='chp'):
+    def find_residue(self, chain, position):
+        """
+        Return the residue of the selected molecule at `chain` and `position`
+        """
+        return self.molecule.findResidue(chimera.MolResId(chain, position))
+
+    def apply_mutations(self, mutations, criteria='chp'):
+        """
+        Apply a batch of mutations, as returned by `Model.query`. If several
+        mutations are requested for the same residue, only the one with the
+        lowest ddG is applied.
+
+        Parameters
+        ----------
+        mutations : list of PopTuple
+        criteria : str, optional
+            See `apply_mutation`
+        """
+        best = {}
+        for m in mutations:
+            key = m.chain, m.id
+            if key not in best or m.ddG < best[key].ddG:
+                best[key] = m
+        new_types = {}
+        for (chain, position), m in sorted(best.items()):
+            residue = self.find_residue(chain, position)
+            if residue is not None:
+                new_types[residue] = m.residue_mutated
+        # Residues in contact are mutated in successive batches, so that each
+        # rotamer search sees the side chains placed before; independent ones
+        # sharing the same new type go together in one useBestRotamers call
+        try:
+            with self.history.transaction(list(new_types)):
+                for batch in self.contact_graph().schedule(list(new_types)):
+                    by_type = {}
+                    for residue in batch:
+                        by_type.setdefault(new_types[residue], []).append(residue)
+                    for new_type, residues in sorted(by_type.items()):
+                        self.apply_mutation(residues, new_type, criteria=criteria)
+        finally:
+            self._forget_structure(new_types)
+
+    def mutate(self, residue, new_type, criteria='chp'):
+        """
+        Same as `apply_mutation`, but recorded in the undo history
+        """
+        try:
+            with self.history.transaction([residue]):
+                self.apply_mutation(residue, new_type, criteria=criteria)
+        finally:
+            self._forget_structure([residue])
+
+    def undo(self):
+        """
+        Revert the last applied mutation or batch of mutations
+        """
+        residues = self.history.undo()
+        self._forget_structure(residues)
+        return residues
+
+    def redo(self):
+        """
+        Re-apply the last reverted mutation or batch of mutations
+        """
+        residues = self.history.redo()
+        self._forget_structure(residues)
+        return residues
+
+    def _forget_structure(self, residues):
+        """
+        Drop the hashes and contact graphs of the molecules of `residues`,
+        which are no longer valid once their side chains changed
+        """
+        molecules = set(r.molecule for r in residues)
+        for molecule in molecules:
+            self._structure_hashes.pop(molecule, None)
+        for key in [k for k in self._contact_graphs if k[0] in molecules]:
+            del self._contact_graphs[key]
+
+    def contact_graph(self, cutoff=5.0):
+        """
+        Residue contact graph of the selected molecule, built once per
+        molecule and cutoff until mutations are applied. See
+        `spatial.ContactGraph`.
+        """
+        key = self.molecule, cutoff
+        graph = self._contact_graphs.get(key)
+        if graph is None:
+            # Identical molecules share the adjacency, stored in canonical
+            # residue order so that the order of their chains does not matter
+            residues = self.molecule.residues
+            order = canonical_order(residues)
+            shared = 'contacts', self.structure_hash(), cutoff
+            canonical = self.content_cache.get(shared)
+            if canonical is None:
+                graph = spatial.ContactGraph(residues, cutoff)
+                rank = dict((i, k) for k, i in enumerate(order))
+                self.content_cache.put(shared, dict((rank[i], set(rank[j] for j in contacts))
+                                                    for i, contacts in graph.adjacency.items()))
+            else:
+                adjacency = dict((order[k], set(order[l] for l in contacts))
+                                 for k, contacts in canonical.items())
+                graph = spatial.ContactGraph(residues, cutoff, adjacency=adjacency)
+            self._contact_graphs[key] = graph
+        return graph
+
+    @classmethod
+    def apply_mutation(cls, residue, new_type, criteria='chp', use_cache=True):
         """
         Apply requested mutation to residue using the best rotamer according to criteria.
 
         Parameters
         ----------
-        residue : chimera.Residue
+        residue : chimera.Residue or list of chimera.Residue
+            If a list is given, all residues are mutated to `new_type` at once
         new_type : str
             Desired mutation, with 3-letter code
         criteria : str, optional
@@ -135,14 +540,31 @@ class Controller(object):
             a method to be used, in the order of the string.
             d -> density, h-> H-bonds maximization, c-> clash minimization, p-> probability.
             Allowed combinations would be `dhcp`, `cp`, or even `p`.
+        use_cache : bool, optional
+            Reuse the outcome of a previous identical search (same residue,
+            type, criteria and surroundings) from `rotamer_cache`.
         """
+        residues = residue if isinstance(residue, (list, tuple)) else [residue]
+        pending, environments = [], {}
+        for r in residues:
+            if not use_cache:
+                pending.append(r)
+                continue
+            cached, environments[r] = cls.rotamer_cache.get(r, new_type, criteria)
+            if cached is None or not restore_rotamer(r, new_type, cached):
+                pending.append(r)
         try:
-            useBestRotamers(new_type, [residue], criteria=criteria)
+            if pending:
+                useBestRotamers(new_type, pending, criteria=criteria)
         except Exception as e:
             raise UserError(e)
         else:
-            for a in residue.atoms:
-                a.display = True
+            for r in pending:
+                if r in environments:
+                    cls.rotamer_cache.put(r, new_type, criteria, environments[r])
+            for r in residues:
+                for a in r.atoms:
+                    a.display = True
 
 
 
@@ -161,20 +583,252 @@ class Model(object):
         - ddG: float
         - negative_score: float
         - positive_score: float
-        - mutations: dict
-            - residue_type, ddG: str, float
+        - mutations: columns.ResidueMutations
+            - residue_type: NamedMutation(solvent_accessibility, ddG)
 
+    The .pop data itself is only kept as `mutations` columns; the
+    per-residue mutations are views over them.
     """
 
-    def __init__(self, gui):
+    # Parsed data and indexes shared by models of identical result sets
+    SHARED_STATE = ('residues', 'mutations', 'ranking', 'matrix', 'sort_orders', 'chain_map',
+                    '_summary')
+
+    def __init__(self, gui, cache=None):
         self.gui = gui
+        self.cache = cache
         self.residues = None
-        
-    def parse(self):
+        self.mutations = None
+        self.ranking = None
+        self.matrix = None
+        self.sort_orders = None
+        self.merge_chains = False
+        self.chain_map = None
+        self.content_hash = None
+        self._summary = None
+        self._files = None
+        self._watched = {}
+
+    def parse(self, merge_chains=False, structure=None):
         pops, pop = self.popsfile, self.popfile
         if pops and pop:
-            self.residues = list(self.parse_pops_and_pop(self.popsfile, self.popfile))
+            return self.parse_files(pops, pop, merge_chains=merge_chains, structure=structure)
+
+    def parse_files(self, pops, pop, merge_chains=False, structure=None):
+        """
+        Parse a .pops/.pop pair, independently of the GUI fields
+
+        Parameters
+        ----------
+        pops, pop : str
+            Path to .pops and .pop files, respectively
+        merge_chains : bool, optional
+            Store the data of chains with identical sequences only once,
+            averaged over the copies. See `symmetry.ChainMap`.
+        structure : str, optional
+            Content hash of the structure the results belong to (see
+            `Controller.structure_hash`). Part of the `cache` key.
+
+        Notes
+        -----
+        With a `cache`, the residues and indexes of identical inputs (same
+        structure and same results contents, see `content_hash`) are built
+        once. Files are hashed while they are parsed; loading again the
+        very same files (same paths, size and mtime) skips the parsing.
+        """
+        self.merge_chains = merge_chains
+        self._files = pops, pop
+        self._watched = {path: self._stat(path) + (os.path.getsize(path),) for path in (pops, pop)}
+        stamp = ('digest',) + tuple((os.path.abspath(p),) + self._watched[p][:2] for p in (pops, pop))
+        self.content_hash = self.cache.get(stamp) if self.cache is not None else None
+        state = self._cached_state(structure)
+        if state is None:
+            digests = hashlib.sha1(), hashlib.sha1()
+            summary = list(parse_pops(pops, digest=digests[0]))
+            datapop = list(parse_pop(pop, digest=digests[1]))
+            self.content_hash = combine_hashes([d.hexdigest() for d in digests])
+            state = self._cached_state(structure)  # Same contents under other names
+        if self.cache is not None:
+            self.cache.put(stamp, self.content_hash)
+        if state is not None:
+            self.__dict__.update(state)
+            return self.residues
+        self._summary = summary
+        self.load(datapop, summary)
+        if self.cache is not None:
+            self.cache.put(('model', structure, self.content_hash, merge_chains),
+                           dict((name, getattr(self, name)) for name in self.SHARED_STATE))
+        return self.residues
+
+    def _cached_state(self, structure):
+        if self.cache is None or self.content_hash is None:
+            return None
+        return self.cache.get(('model', structure, self.content_hash, self.merge_chains))
+
+    @staticmethod
+    def _stat(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime
+
+    def changed_on_disk(self):
+        """
+        Cheap check (size and mtime only) of whether the parsed files changed
+        """
+        return any(self._stat(path) != state[:2] for path, state in self._watched.items())
+
+    def reload(self):
+        """
+        Re-read the parsed files if they changed on disk. Plain files that
+        only grew are parsed from the last read position onwards; anything
+        else is parsed again from scratch.
+
+        Returns
+        -------
+        ResultsDiff or None
+            (chain, id) keys of the residues added, changed or removed,
+            or None if nothing changed
+        """
+        if not self._watched or not self.changed_on_disk():
+            return None
+        pops, pop = self._files
+        watched = dict(self._watched)
+        try:
+            datapop = self._reread(pop, self._mutation_rows, parse_pop, parse_pop_line)
+            summary = self._reread(pops, lambda: self._summary, parse_pops, parse_pops_line)
+        except Exception:
+            self._watched = watched  # Read everything again next time
+            raise
+        old = {(r.chain, r.id): r for r in self.residues}
+        self._summary = summary
+        self.content_hash = None  # Not worth reading everything again to know it
+        self.load(datapop, summary)
+        new = {(r.chain, r.id): r for r in self.residues}
+        diff = ResultsDiff([k for k in new if k not in old],
+                           [k for k in new if k in old and new[k] != old[k]],
+                           [k for k in old if k not in new])
+        if any(diff):
+            return diff
+
+    def _reread(self, path, rows, parse_file, parse_line):
+        """
+        Rows of `path` after it changed on disk. `rows` returns those
+        already read, or None if they cannot be rebuilt; the file is then
+        parsed again from scratch.
+        """
+        size, mtime, offset = self._watched[path]
+        new_size, new_mtime = self._stat(path)
+        unchanged = (new_size, new_mtime) == (size, mtime)
+        # Appended data can only be parsed on its own if the last read ended a
+        # line: the first parse reads a trailing line without newline too
+        grown = new_size > size and compression(path)[0] is None and at_line_start(path, offset)
+        previous = rows() if unchanged or grown else None
+        if previous is not None and unchanged:
+            return previous
+        if previous is not None:
+            lines, offset = read_appended_lines(path, offset)
+            rows = previous + [parse_line(line) for line in lines]
+        else:
+            rows, offset = list(parse_file(path)), new_size
+        self._watched[path] = new_size, new_mtime, offset
+        return rows
+
+    def _mutation_rows(self):
+        """
+        .pop rows rebuilt from `mutations`, or None if chains were merged
+        (the collapsed rows do not match the file anymore)
+        """
+        if self.chain_map is not None:
+            return None
+        return self.mutations.rows()
+
+    def load(self, datapop, summary):
+        """
+        Build the model (residues list plus derived indexes) from already parsed data.
+
+        Parameters
+        ----------
+        datapop : list of PopTuple
+            Contents of the .pop file. Only kept as `mutations` columns.
+        summary : iterable of tuple
+            Contents of the .pops file, as yielded by `parse_pops`. If
+            `merge_chains` is set, identical chains are collapsed into
+            their reference chain.
+        """
+        residues = [NamedResidue(*(tuple(row) + (None,))) for row in summary]
+        self.chain_map = None
+        if self.merge_chains:
+            chain_map = ChainMap(residues)
+            if chain_map:
+                self.chain_map = chain_map
+                datapop, residues = chain_map.collapse(datapop, residues)
+        self.mutations = MutationColumns(datapop, record=PopTuple)
+        del datapop
+        self.ranking = RankIndex(self.mutations['ddG'])
+        order, bounds = self.mutations.residue_rows([(r.chain, r.id) for r in residues])
+        self.residues = [r._replace(mutations=ResidueMutations(self.mutations, order[start:stop], NamedMutation))
+                         for r, start, stop in zip(residues, bounds[:-1], bounds[1:])]
+        self.matrix = DDGMatrix(self.mutations, [(r.chain, r.id) for r in self.residues])
+        self.sort_orders = SortOrders(self.residues, RESIDUE_SORT_FIELDS)
+        return self.residues
+
+    def load_stored(self, database, run_id, merge_chains=False):
+        """
+        Load a run previously imported in a `database.ResultsDatabase`,
+        instead of parsing the files.
+        """
+        self.merge_chains = merge_chains
+        self._files, self._watched = None, {}
+        self.content_hash = None
+        datapop = [PopTuple(*row) for row in database.mutation_rows(run_id)]
+        self._summary = database.residue_rows(run_id)
+        return self.load(datapop, self._summary)
+
+    def broadcast(self):
+        """
+        Residue rows of every chain. With merged chains, each copy gets the
+        row of its reference chain; otherwise this is just `residues`.
+        """
+        if self.chain_map is None:
             return self.residues
+        return self.chain_map.broadcast(self.residues)
+
+    def query(self, text=None, **criteria):
+        """
+        Return the mutations (PopTuple) matching all criteria.
+
+        Parameters
+        ----------
+        text : str, optional
+            Textual query, like ``ddG < -0.5 and ss == H and sa > 30 and chain == B``
+        criteria : dict, optional
+            Keyword criteria, like ``ddG__lt=-0.5, ss='H'``. See `MutationColumns.mask`.
+        """
+        if self.mutations is None:
+            return []
+        if text:
+            criteria.update(parse_query(text))
+        return self.mutations.rows(self.mutations.query(**criteria))
+
+    def top_mutations(self, k=10, stabilizing=True):
+        """
+        Return the `k` best (lowest ddG) mutations in the whole structure,
+        or the `k` worst if `stabilizing` is False.
+
+        Parameters
+        ----------
+        k : int, optional
+            Number of mutations to retrieve
+        stabilizing : bool, optional
+            Rank by ascending ddG if True, descending otherwise
+
+        Returns
+        -------
+        list of PopTuple
+        """
+        if self.ranking is None:
+            return []
+        indices = self.ranking.smallest(k) if stabilizing else self.ranking.largest(k)
+        return self.mutations.rows(indices)
 
     @property
     def popsfile(self):
@@ -197,7 +851,7 @@ class Model(object):
         self.gui._popfile.set(value)
 
     @staticmethod
-    def parse_pops_and_pop(pops, pop):
+    def parse_pops_and_pop(pops, pop, datapop=None):
         """
         Load PoPMuSiC data from .pops and .pop file (summary and individual data)
         into a single object representation
@@ -206,6 +860,8 @@ class Model(object):
         ----------
         pops, pop : str
             Path to .pops and .pop files, respectively
+        datapop : list of PopTuple, optional
+            Already parsed contents of `pop`, to avoid reading it twice
 
         Yields
         ------
@@ -213,15 +869,9 @@ class Model(object):
             NamedResidue instances for each line in .pops file, and, subsequently,
             for each residue in molecule
         """
-        datapop = list(parse_pop(pop))
-        for line in iterlines(pops):
-            chain, i, res, ss, sa, ddg, neg, pos = line.split()
-            i = int(i)
-            sa, ddg, neg, pos = map(float, (sa, ddg, neg, pos))
-            mutation_list = [m for m in datapop if m.chain == chain and m.id == i]
-            mutations = {m.residue_mutated: NamedMutation(m.sa, m.ddG)
-                         for m in mutation_list}
-            yield NamedResidue(chain, i, res, ss, sa, ddg, neg, pos, mutations)
+        if datapop is None:
+            datapop = parse_pop(pop)
+        return join_pops_and_pop(parse_pops(pops), datapop)
 
 
 ###
@@ -234,32 +884,229 @@ def ignored(*exceptions):
     except exceptions:
         pass
 
-def parse_pop(path):
+@contextlib.contextmanager
+def database_errors():
+    """
+    Report errors of the results database to the user as UserError
+    """
+    try:
+        yield
+    except sqlite3.Error as e:
+        raise UserError('Results database error: {}'.format(e))
+
+def join_pops_and_pop(summary, datapop):
+    """
+    Attach the mutations in `datapop` to each residue in `summary`
+
+    Parameters
+    ----------
+    summary : iterable of tuple
+        (chain, id, residue, ss, sa, ddG, negative, positive) rows, as
+        yielded by `parse_pops`
+    datapop : iterable of PopTuple
+
+    Yields
+    ------
+    NamedResidue : namedtuple
+    """
+    by_residue = {}
+    for m in datapop:
+        by_residue.setdefault((m.chain, m.id), []).append(m)
+    for chain, i, res, ss, sa, ddg, neg, pos in summary:
+        mutations = {m.residue_mutated: NamedMutation(m.sa, m.ddG)
+                     for m in by_residue.get((chain, i), ())}
+        yield NamedResidue(chain, i, res, ss, sa, ddg, neg, pos, mutations)
+
+
+def parse_pops(path, digest=None):
+    """
+    Parse a .pops file
+
+    Parameters
+    ----------
+    path : str
+    digest : hashlib object, optional
+        Updated with the (decompressed) contents of the file
+
+    Yields
+    ------
+    tuple
+        (chain, id, residue, ss, sa, ddG, negative, positive) for each line in file
+    """
+    for line in iterlines(path, digest=digest):
+        yield parse_pops_line(line)
+
+
+def parse_pops_line(line):
+    chain, i, res, ss, sa, ddg, neg, pos = line.split()
+    sa, ddg, neg, pos = map(float, (sa, ddg, neg, pos))
+    return intern(chain), int(i), intern(res), intern(ss), sa, ddg, neg, pos
+
+
+def parse_header(path):
+    """
+    Parse the `# Key: value` lines at the top of a .pop or .pops file
+
+    Returns
+    -------
+    dict
+    """
+    header = {}
+    with open_results(path) as f:
+        for line in f:
+            if not isinstance(line, str):  # Python 3 bytes
+                line = line.decode('utf-8')
+            line = line.strip()
+            if line and not line.startswith('#'):
+                break
+            key, sep, value = line.lstrip('# ').partition(':')
+            if sep and not key.startswith('Col'):
+                header[key.strip()] = value.strip()
+    return header
+
+
+def parse_pop(path, digest=None):
     """
     Parse a .pop file
 
+    Parameters
+    ----------
+    path : str
+    digest : hashlib object, optional
+        Updated with the (decompressed) contents of the file
+
     Yields
     ------
     PopTuple : namedtuple
         PopTuple instances for each line in file
     """
-    for line in iterlines(path):
-        chain, i, wt, mt, ss, sa, ddg = line.split()
-        i, sa, ddg = int(i), float(sa), float(ddg)
-        yield PopTuple(chain, i, wt, mt, ss, sa, ddg)
+    for line in iterlines(path, digest=digest):
+        yield parse_pop_line(line)
 
 
-def iterlines(path):
-    with open(path) as f:
+def parse_pop_line(line):
+    chain, i, wt, mt, ss, sa, ddg = line.split()
+    i, sa, ddg = int(i), float(sa), float(ddg)
+    # Interned codes: one shared object per distinct value, compared by identity
+    return PopTuple(intern(chain), i, intern(wt), intern(mt), intern(ss), sa, ddg)
+
+
+def iterlines(path, digest=None):
+    with open_results(path) as f:
         for line in f:
+            if digest is not None:
+                digest.update(line)
+            if not isinstance(line, str):  # Python 3 bytes
+                line = line.decode('utf-8')
             line = line.strip()
             if line and not line.startswith("#"):
-                print(line)
                 yield line
 
+
+def open_results(path, buffer_size=1 << 16):
+    """
+    Open a result file for binary reading, transparently decompressing it
+    if it is gzip, bz2 or xz-compressed. Compression is detected by the
+    magic bytes, not by the extension.
+
+    Parameters
+    ----------
+    path : str
+    buffer_size : int, optional
+        Size of the chunks read from uncompressed files
+
+    Returns
+    -------
+    file-like object
+    """
+    signature, opener = compression(path)
+    if signature is None:
+        return io.open(path, 'rb', buffering=buffer_size)
+    if opener is None:
+        raise ValueError('Cannot decompress {}: lzma module not available'.format(path))
+    return opener(path)  # decompressors already read in buffered chunks
+
+
+def compression(path):
+    """
+    Detect the compression of `path` by its magic bytes
+
+    Returns
+    -------
+    signature, opener
+        Both None if the file is not compressed
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(6)
+    for signature, opener in COMPRESSION_SIGNATURES:
+        if magic.startswith(signature):
+            return signature, opener
+    return None, None
+
+
+def at_line_start(path, offset):
+    """
+    Whether byte `offset` of a plain text file starts a line, i.e. it is
+    the beginning of the file or right after a newline
+    """
+    if offset == 0:
+        return True
+    with io.open(path, 'rb') as f:
+        f.seek(offset - 1)
+        return f.read(1) == b'\n'
+
+
+def read_appended_lines(path, offset):
+    """
+    Read the complete lines added to a plain text file after byte `offset`.
+    A trailing line without newline is left for the next call.
+
+    Returns
+    -------
+    lines : list of str
+        Data lines (no blanks or comments)
+    offset : int
+        Position right after the last complete line read
+    """
+    with io.open(path, 'rb') as f:
+        f.seek(offset)
+        chunk = f.read()
+    end = chunk.rfind(b'\n') + 1
+    lines = []
+    for line in chunk[:end].splitlines():
+        if not isinstance(line, str):  # Python 3 bytes
+            line = line.decode('utf-8')
+        line = line.strip()
+        if line and not line.startswith('#'):
+            lines.append(line)
+    return lines, offset + end
+
 PopTuple = namedtuple('PopMusicPOP', ['chain', 'id', 'residue_wildtype', 'residue_mutated',
                                       'ss', 'sa', 'ddG'])
 NamedResidue = namedtuple("NamedResidue", ['chain', 'id', 'residue_type', 
                                            'secondary_structure', 'solvent_accessibility', 'ddG', 
                                            'negative_score', 'positive_score', 'mutations'])
 NamedMutation = namedtuple("NamedMutation", ['solvent_accessibility', 'ddG'])
+Hotspot = namedtuple("Hotspot", ['residues', 'score'])
+
+
+class ResidueKey(namedtuple("ResidueKey", ['chain', 'id', 'residue_type'])):
+
+    """
+    Identifier of a residue in the results tables, displayed as `:123.A ASP`
+    """
+
+    __slots__ = ()
+
+    def __str__(self):
+        return ':{}.{} {}'.format(self.id, self.chain, self.residue_type)
+
+
+ResultsDiff = namedtuple("ResultsDiff", ['added', 'changed', 'removed'])
+RESIDUE_SORT_FIELDS = ('solvent_accessibility', 'ddG', 'negative_score', 'positive_score')
+COMPRESSION_SIGNATURES = [
+    (b'\x1f\x8b', lambda path: gzip.GzipFile(path, 'rb')),
+    (b'BZh', lambda path: bz2.BZ2File(path, 'rb')),
+    (b'\xfd7zXZ', (lambda path: lzma.LZMAFile(path, 'rb')) if lzma else None),
+]
+COMPRESSED_EXTENSIONS = ('', '.gz', '.bz2', '.xz')
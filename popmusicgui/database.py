@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Local SQLite storage of PoPMuSiC runs, for fast cross-run queries.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+from collections import namedtuple
+from itertools import islice
+import os
+import sqlite3
+import time
+# Own
+from core import parse_header, parse_pop, parse_pops
+from columns import basestring_
+
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.tangram_popmusic.sqlite')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    structure TEXT NOT NULL,
+    pops_path TEXT,
+    pop_path TEXT,
+    chains TEXT,
+    imported REAL
+);
+CREATE TABLE IF NOT EXISTS residues (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    chain TEXT, position INTEGER, residue_type TEXT, ss TEXT,
+    sa REAL, ddG REAL, negative_score REAL, positive_score REAL
+);
+CREATE TABLE IF NOT EXISTS mutations (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    chain TEXT, position INTEGER, wildtype TEXT, mutant TEXT, ss TEXT,
+    sa REAL, ddG REAL
+);
+CREATE INDEX IF NOT EXISTS runs_structure ON runs (structure);
+CREATE INDEX IF NOT EXISTS residues_run ON residues (run_id);
+CREATE INDEX IF NOT EXISTS mutations_run ON mutations (run_id);
+CREATE INDEX IF NOT EXISTS mutations_position ON mutations (chain, position);
+CREATE INDEX IF NOT EXISTS mutations_wildtype ON mutations (wildtype);
+CREATE INDEX IF NOT EXISTS mutations_mutant ON mutations (mutant);
+CREATE INDEX IF NOT EXISTS mutations_ddG ON mutations (ddG);
+"""
+
+# Public field names (as in core.PopTuple and columns.ALIASES) -> SQL columns
+FIELDS = {
+    'run_id': 'm.run_id', 'run': 'm.run_id',
+    'structure': 'r.structure',
+    'chain': 'm.chain',
+    'id': 'm.position', 'position': 'm.position',
+    'residue_wildtype': 'm.wildtype', 'wildtype': 'm.wildtype', 'wt': 'm.wildtype',
+    'residue_mutated': 'm.mutant', 'mutant': 'm.mutant', 'mt': 'm.mutant',
+    'ss': 'm.ss', 'secondary_structure': 'm.ss',
+    'sa': 'm.sa', 'solvent_accessibility': 'm.sa',
+    'ddG': 'm.ddG', 'ddg': 'm.ddG',
+}
+SQL_OPERATORS = {'lt': '<', 'le': '<=', 'gt': '>', 'ge': '>=', 'eq': '=', 'ne': '!=', 'in': 'IN'}
+
+StoredRun = namedtuple('StoredRun', ['id', 'structure', 'pops_path', 'pop_path', 'chains', 'imported'])
+StoredMutation = namedtuple('StoredMutation', ['run_id', 'structure', 'chain', 'id', 'residue_wildtype',
+                                               'residue_mutated', 'ss', 'sa', 'ddG'])
+
+
+class ResultsDatabase(object):
+
+    """
+    SQLite database holding any number of PoPMuSiC runs.
+
+    Parameters
+    ----------
+    path : str, optional
+        Location of the database file. Use ':memory:' for a temporary one.
+    batch_size : int, optional
+        Number of rows sent in each `executemany` call while importing
+    """
+
+    def __init__(self, path=DEFAULT_PATH, batch_size=5000):
+        self.path = path
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA foreign_keys = ON')
+        self.connection.execute('PRAGMA synchronous = NORMAL')
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def import_files(self, pops, pop, structure=None):
+        """
+        Bulk-load a .pops/.pop pair in a single transaction.
+
+        Parameters
+        ----------
+        pops, pop : str
+            Path to .pops and .pop files, respectively
+        structure : str, optional
+            Name of the structure the run belongs to. Defaults to the
+            basename of `pops` without extension.
+
+        Returns
+        -------
+        run_id : int
+        """
+        if structure is None:
+            structure = os.path.splitext(os.path.basename(pops))[0]
+        chains = parse_header(pops).get('Chains considered')
+        with self.connection:
+            cursor = self.connection.execute(
+                'INSERT INTO runs (structure, pops_path, pop_path, chains, imported) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (structure, os.path.abspath(pops), os.path.abspath(pop), chains, time.time()))
+            run_id = cursor.lastrowid
+            self._insert_many('INSERT INTO residues VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              ((run_id,) + tuple(row) for row in parse_pops(pops)))
+            self._insert_many('INSERT INTO mutations VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                              ((run_id,) + tuple(row) for row in parse_pop(pop)))
+        return run_id
+
+    def import_many(self, pairs):
+        """
+        Import several runs. `pairs` is an iterable of (pops, pop) or
+        (pops, pop, structure) tuples. Returns the list of new run ids.
+        """
+        return [self.import_files(*pair) for pair in pairs]
+
+    def _insert_many(self, statement, rows):
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, self.batch_size))
+            if not batch:
+                break
+            self.connection.executemany(statement, batch)
+
+    def delete_run(self, run_id):
+        with self.connection:
+            self.connection.execute('DELETE FROM runs WHERE id = ?', (run_id,))
+
+    def runs(self, structure=None):
+        """
+        List stored runs, optionally only those of `structure`
+
+        Returns
+        -------
+        list of StoredRun
+        """
+        sql, params = 'SELECT * FROM runs', ()
+        if structure is not None:
+            sql, params = sql + ' WHERE structure = ?', (structure,)
+        return [StoredRun(*row) for row in self.connection.execute(sql + ' ORDER BY id', params)]
+
+    def residue_rows(self, run_id):
+        """
+        Summary rows of a run, with the same layout as `core.parse_pops`
+        """
+        return self.connection.execute(
+            'SELECT chain, position, residue_type, ss, sa, ddG, negative_score, positive_score '
+            'FROM residues WHERE run_id = ? ORDER BY rowid', (run_id,)).fetchall()
+
+    def mutation_rows(self, run_id):
+        """
+        Mutation rows of a run, with the same layout as `core.PopTuple`
+        """
+        return self.connection.execute(
+            'SELECT chain, position, wildtype, mutant, ss, sa, ddG '
+            'FROM mutations WHERE run_id = ? ORDER BY rowid', (run_id,)).fetchall()
+
+    def query(self, order_by='ddG', limit=None, **criteria):
+        """
+        Query mutations across all stored runs.
+
+        Criteria follow the `field__op=value` syntax of `columns.MutationColumns.mask`,
+        plus the `structure` and `run_id` fields. For example,
+        ``query(structure='1abc', chain='B', ddG__lt=-0.5, limit=20)``.
+
+        Returns
+        -------
+        list of StoredMutation
+        """
+        clauses, params = [], []
+        for key, value in criteria.items():
+            field, _, op = key.partition('__')
+            op = op or 'eq'
+            if field not in FIELDS:
+                raise KeyError('Unknown field {}'.format(field))
+            if op not in SQL_OPERATORS:
+                raise KeyError('Unknown operator {}'.format(op))
+            if op == 'in':
+                if isinstance(value, basestring_):
+                    value = [v.strip() for v in value.split(',')]
+                value = list(value)
+                clauses.append('{} IN ({})'.format(FIELDS[field], ', '.join('?' * len(value))))
+                params.extend(value)
+            else:
+                clauses.append('{} {} ?'.format(FIELDS[field], SQL_OPERATORS[op]))
+                params.append(value)
+        sql = ('SELECT m.run_id, r.structure, m.chain, m.position, m.wildtype, m.mutant, '
+               'm.ss, m.sa, m.ddG FROM mutations m JOIN runs r ON r.id = m.run_id')
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        if order_by:
+            descending = order_by.startswith('-')
+            order_by = order_by.lstrip('-')
+            if order_by not in FIELDS:
+                raise KeyError('Unknown field {}'.format(order_by))
+            sql += ' ORDER BY {}{}'.format(FIELDS[order_by], ' DESC' if descending else '')
+        if limit is not None:
+            sql += ' LIMIT {:d}'.format(limit)
+        return [StoredMutation(*row) for row in self.connection.execute(sql, params)]
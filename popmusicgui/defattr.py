@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Write PoPMuSiC data as Chimera attribute assignment (defattr) files, so
+they can be loaded with Chimera's native reader and cached next to the results
+(or in the temporary directory, if the results directory is read-only).
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import errno
+import hashlib
+import io
+import os
+import tempfile
+
+FIELDS = ('solvent_accessibility', 'ddG', 'negative_score', 'positive_score')
+PREFIX = 'popmusic_'
+
+
+def cache_paths(pops, prefix=PREFIX, fields=FIELDS, directory=None):
+    """
+    Location of the defattr files corresponding to a .pops file: one per
+    field, named `<pops>.<prefix><field>.defattr` and stored next to it
+    unless `directory` is given. If the directory of `pops` is not
+    writable, a subdirectory of the temporary directory is used instead.
+
+    Returns
+    -------
+    dict
+        {field: path}
+    """
+    if directory is None:
+        directory = os.path.dirname(os.path.abspath(pops))
+        if not os.access(directory, os.W_OK):
+            directory = fallback_directory(directory)
+    base = os.path.join(directory, os.path.basename(pops))
+    return dict((field, '{}.{}{}.defattr'.format(base, prefix, field)) for field in fields)
+
+
+def fallback_directory(directory):
+    """
+    Writable cache directory standing for the read-only `directory`
+    """
+    name = hashlib.sha1(directory.encode('utf-8')).hexdigest()[:16]
+    path = os.path.join(tempfile.gettempdir(), 'popmusic_defattr', name)
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return path
+
+
+def is_fresh(paths, sources):
+    """
+    True if all `paths` exist and are newer than every file in `sources`
+    """
+    try:
+        oldest = min(os.path.getmtime(p) for p in paths)
+        return oldest >= max(os.path.getmtime(s) for s in sources)
+    except (OSError, ValueError):
+        return False
+
+
+def write_defattr(residues, paths, prefix=PREFIX):
+    """
+    Stream one defattr file per field.
+
+    Parameters
+    ----------
+    residues : list of core.NamedResidue
+    paths : dict
+        {field: path}, as returned by `cache_paths`
+    prefix : str, optional
+        Prefix of the attribute names
+    """
+    specs = [':{}.{}'.format(r.id, r.chain) if r.chain.strip() else ':{}'.format(r.id)
+             for r in residues]
+    for field, path in paths.items():
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(u'attribute: {}{}\nmatch mode: 1-to-1\nrecipient: residues\n'.format(prefix, field))
+            f.writelines(u'\t{}\t{}\n'.format(spec, getattr(r, field))
+                         for spec, r in zip(specs, residues))
+    return paths
+
+
+def load_defattr(paths, molecule):
+    """
+    Assign the attributes in `paths` (iterable of defattr files) to `molecule`
+    using Chimera's own bulk reader.
+    """
+    from AddAttr import addAttributes
+    for path in paths:
+        addAttributes(path, models=[molecule], log=False, raiseAttrDialog=False)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Export parsed PoPMuSiC data as columnar files (Parquet, Feather or NPZ)
+or as in-memory DataFrames.
+
+Usage from the command line (with a Chimera-enabled interpreter, like pychimera)::
+
+    python -m popmusicgui.export result.pops result.pop output.parquet
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import argparse
+import os
+# Additional 3rd parties
+import numpy as np
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+# Own
+from core import Model, NamedResidue
+from columns import MutationColumns
+
+FORMATS = ('parquet', 'feather', 'npz')
+RESIDUE_FIELDS = NamedResidue._fields[:-1]  # everything but the mutations view
+
+
+def tables(model):
+    """
+    Columns of the parsed model, as dicts of NumPy arrays.
+
+    Numeric columns of the mutations table are the very arrays held by
+    `model.mutations` (no copies); categorical ones are decoded from their
+    uint8 codes. The residues table is built from `model.residues`.
+
+    Returns
+    -------
+    dict
+        {'mutations': {column: array}, 'residues': {column: array}}
+    """
+    residues = MutationColumns([r[:-1] for r in model.residues], fields=RESIDUE_FIELDS)
+    return {'mutations': model.mutations.columns, 'residues': residues.columns}
+
+
+def to_dataframe(model, table='mutations'):
+    """
+    Return `table` ('mutations' or 'residues') as a pandas DataFrame. Numeric
+    columns share their buffers with the model whenever pandas allows it.
+    """
+    import pandas as pd
+    columns = tables(model)[table]
+    fields = model.mutations.fields if table == 'mutations' else RESIDUE_FIELDS
+    return pd.DataFrame(columns, columns=list(fields), copy=False)
+
+
+def export(model, path, format=None):
+    """
+    Write the parsed model to `path`.
+
+    Parquet and Feather require pyarrow, and write one file per table
+    (`<name>.mutations.<ext>` and `<name>.residues.<ext>`). If pyarrow is
+    not available, or `format` is 'npz', a single NPZ archive is written
+    instead, with `mutations/<column>` and `residues/<column>` entries.
+
+    Parameters
+    ----------
+    model : core.Model
+        An already parsed model
+    path : str
+        Output path. Its extension determines the format unless `format` is set.
+    format : str, optional
+        One of `FORMATS`
+
+    Returns
+    -------
+    list of str
+        Paths actually written
+    """
+    base, ext = os.path.splitext(path)
+    if format is None:
+        format = ext.lstrip('.').lower() or 'npz'
+    if format not in FORMATS:
+        raise ValueError('Format must be one of {}'.format(', '.join(FORMATS)))
+    if format != 'npz' and pa is None:
+        format = 'npz'
+    data = tables(model)
+    if format == 'npz':
+        path = base + '.npz'
+        np.savez(path, **dict(('{}/{}'.format(table, name), column)
+                              for table, columns in data.items()
+                              for name, column in columns.items()))
+        return [path]
+    written = []
+    for table, columns in sorted(data.items()):
+        names = sorted(columns)
+        arrow = pa.Table.from_arrays([pa.array(columns[name]) for name in names], names=names)
+        out = '{}.{}.{}'.format(base, table, format)
+        if format == 'parquet':
+            pq.write_table(arrow, out)
+        else:
+            feather.write_feather(arrow, out)
+        written.append(out)
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export PoPMuSiC results as columnar files')
+    parser.add_argument('pops', help='Path to .pops file')
+    parser.add_argument('pop', help='Path to .pop file')
+    parser.add_argument('output', help='Output path (.parquet, .feather or .npz)')
+    parser.add_argument('--format', choices=FORMATS, default=None)
+    args = parser.parse_args(argv)
+    model = Model(gui=None)
+    model.parse_files(args.pops, args.pop)
+    for path in export(model, args.output, format=args.format):
+        print(path)
+
+
+if __name__ == '__main__':
+    main()
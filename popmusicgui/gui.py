@@ -4,6 +4,7 @@
 
 from __future__ import print_function, division
 # Python stdlib
+from collections import OrderedDict
 import Tkinter as tk
 from tkFileDialog import askopenfilename
 import os
@@ -15,12 +16,13 @@ import types
 import chimera
 from chimera.widgets import MoleculeScrolledListBox, SortableTable
 from chimera.baseDialog import ModelessDialog
-from ShowAttr import ShowAttrDialog
 # Additional 3rd parties
-
+import numpy as np
 # Own
 from libtangram.ui import TangramBaseDialog
-from core import Controller, Model
+from core import Controller, Model, ResidueKey, COMPRESSED_EXTENSIONS
+from columns import ResidueIndex
+import coloring
 
 
 ui = None
@@ -30,7 +32,7 @@ def showUI():
     global ui
     if not ui:
         ui = PoPMuSiCExtension()
-    model = Model(gui=ui)
+    model = Model(gui=ui, cache=Controller.content_cache)
     controller = Controller(gui=ui, model=model)
     ui.enter()
 
@@ -47,6 +49,10 @@ class PoPMuSiCExtension(TangramBaseDialog):
         # Variables
         self._popsfile = tk.StringVar()
         self._popfile = tk.StringVar()
+        self._use_stored = tk.BooleanVar()
+        self._stored_run = tk.StringVar()
+        self._use_defattr = tk.BooleanVar()
+        self._merge_chains = tk.BooleanVar()
 
         # Fire up
         super(PoPMuSiCExtension, self).__init__(*args, **kwargs)
@@ -79,8 +85,44 @@ class PoPMuSiCExtension(TangramBaseDialog):
             button.grid(row=i+1, column=2, padx=3, pady=3)
             setattr(self, 'ui_' + var + '_button', button)
 
+        stored_frame = tk.LabelFrame(self.canvas, text='Or load a stored run')
+        stored_frame.columnconfigure(1, weight=1)
+        self.ui_use_stored = tk.Checkbutton(stored_frame, text='Load stored run',
+                                            variable=self._use_stored)
+        self.ui_use_stored.grid(row=0, column=0, padx=3, pady=3, sticky='w')
+        self.ui_stored_runs = tk.OptionMenu(stored_frame, self._stored_run, '')
+        self.ui_stored_runs.grid(row=0, column=1, padx=3, pady=3, sticky='we')
+        self.ui_store_btn = tk.Button(stored_frame, text='Store files')
+        self.ui_store_btn.grid(row=0, column=2, padx=3, pady=3)
+
+        options_frame = tk.LabelFrame(self.canvas, text='Options')
+        self.ui_use_defattr = tk.Checkbutton(options_frame, variable=self._use_defattr,
+                                             text='Load attributes from cached defattr files')
+        self.ui_use_defattr.pack(padx=3, pady=3, anchor='w')
+        self.ui_merge_chains = tk.Checkbutton(options_frame, variable=self._merge_chains,
+                                              text='Merge identical chains (homo-oligomers)')
+        self.ui_merge_chains.pack(padx=3, pady=3, anchor='w')
+
         note_frame.pack(fill='x', padx=5, pady=5)
         input_frame.pack(expand=True, fill='both', padx=5, pady=5)
+        stored_frame.pack(fill='x', padx=5, pady=5)
+        options_frame.pack(fill='x', padx=5, pady=5)
+
+    def set_stored_runs(self, runs):
+        """
+        Fill the stored runs menu with `runs` (list of database.StoredRun)
+        """
+        menu = self.ui_stored_runs['menu']
+        menu.delete(0, 'end')
+        for run in runs:
+            label = '{}: {}'.format(run.id, run.structure)
+            menu.add_command(label=label, command=lambda l=label: self._stored_run.set(l))
+        self._stored_run.set('{}: {}'.format(runs[-1].id, runs[-1].structure) if runs else '')
+
+    @property
+    def stored_run_id(self):
+        value = self._stored_run.get()
+        return int(value.split(':')[0]) if value else None
 
     def Run(self):
         pass
@@ -91,7 +133,8 @@ class PoPMuSiCExtension(TangramBaseDialog):
         super(PoPMuSiCExtension, self).Close()
 
     def _browse_cb(self, var, extension):
-        path = askopenfilename()
+        patterns = ' '.join('*' + extension + c for c in COMPRESSED_EXTENSIONS)
+        path = askopenfilename(filetypes=[('PoPMuSiC ' + extension, patterns), ('All files', '*')])
         if os.path.isfile(path):
             var.set(path)
 
@@ -99,11 +142,16 @@ class PoPMuSiCExtension(TangramBaseDialog):
 class PoPMuSiCResultsDialog(TangramBaseDialog):
 
     buttons = ('Close',)
-    _show_attr_dialog = None
     help = "https://github.com/insilichem/tangram_popmusicgui"
     VERSION = '0.0.1'
     VERSION_URL = "https://api.github.com/repos/insilichem/tangram_popmusicgui/releases/latest"
-
+    HEATMAP_CELL = 6, 10  # width, height of each cell in pixels
+    HEATMAP_MISSING = '#808080'
+    SELECTION_DELAY = 80  # ms to wait for further selections before rendering
+    PREFETCH_NEIGHBOURS = 5  # rows above and below the selection built while idle
+    ROW_CACHE_SIZE = 64  # residues whose mutation rows are kept built
+    # Summary table columns sorted with the model's precomputed permutations
+    SUMMARY_SORT_FIELDS = {2: 'solvent_accessibility', 3: 'ddG', 4: 'negative_score', 5: 'positive_score'}
 
     def __init__(self, molecule=None, controller=None, *args, **kwargs):
         self.molecule = molecule
@@ -117,6 +165,31 @@ class PoPMuSiCResultsDialog(TangramBaseDialog):
         self._keys = None
         self._mutations = None
         self._previously_selected_residue = None
+        self._filtered = []
+        self._ranked = []
+        self._summary = []
+        self._mutation_rows = []
+        self._heatmap_image = None
+        self._selected_key = None
+        self._selection_job = None
+        self._pending_selection = None
+        self._row_cache = OrderedDict()
+        self._prefetch_job = None
+        self._sort_column = None
+        self._sort_descending = False
+        self._sorted_summary = None
+        self._displayed = None
+        self._styles = {}
+        self._comparison = None
+        self._ranking_stabilizing = True
+        self._filter = tk.StringVar()
+        self._search = tk.StringVar()
+        self._search_index = None
+        self._search_hits = []
+        self._search_hit = 0
+        self._watch = tk.BooleanVar()
+        self._hotspots_radius = tk.DoubleVar(value=8.0)
+        self._ranking_k = tk.IntVar(value=10)
         # Fire up
         super(PoPMuSiCResultsDialog, self).__init__(*args, **kwargs)
 
@@ -126,6 +199,13 @@ class PoPMuSiCResultsDialog(TangramBaseDialog):
         # Summary
         self.ui_summary_frame = tk.LabelFrame(master=self.canvas, text='Summary', width=1000)
         self.ui_summary_table = SortableTable(self.ui_summary_frame)
+        self.ui_search_frame = tk.Frame(self.ui_summary_frame)
+        tk.Label(self.ui_search_frame, text='Find residue').pack(side='left')
+        self.ui_search_entry = tk.Entry(self.ui_search_frame, textvariable=self._search)
+        self.ui_search_entry.bind('<Return>', lambda *a: self.search_residue(step=1))
+        self.ui_search_entry.bind('<Shift-Return>', lambda *a: self.search_residue(step=-1))
+        self._search.trace('w', lambda *a: self.search_residue())
+        self.ui_search_label = tk.Label(self.ui_search_frame, width=8, anchor='e')
 
         self.ui_summary_actions_frame = tk.LabelFrame(self.canvas, text='Actions')
         self.ui_summary_actions_0 = tk.Button(self.ui_summary_actions_frame, text='Color by ddG',
@@ -134,29 +214,122 @@ class PoPMuSiCResultsDialog(TangramBaseDialog):
                                           command=self.color_by_sasa)
         self.ui_summary_actions_2 = tk.Button(self.ui_summary_actions_frame, text='Reset color',
                                           command=self.reset_colors)
+        self.ui_summary_actions_3 = tk.Checkbutton(self.ui_summary_actions_frame, text='Watch files',
+                                                   variable=self._watch, command=self.toggle_watch)
 
         # Mutations
         self.ui_mutations_frame = tk.LabelFrame(master=self.canvas, text='Mutations')
         self.ui_mutations_table = SortableTable(self.ui_mutations_frame)
+        self.ui_filter_frame = tk.Frame(self.ui_mutations_frame)
+        self.ui_filter_entry = tk.Entry(self.ui_filter_frame, textvariable=self._filter)
+        self.ui_filter_entry.bind('<Return>', lambda *a: self.filter_mutations())
+        self.ui_filter_btn = tk.Button(self.ui_filter_frame, text='Filter',
+                                       command=self.filter_mutations)
 
         self.ui_mutations_actions_frame = tk.LabelFrame(self.canvas, text='Actions')
         self.ui_mutations_actions_0 = tk.Button(self.ui_mutations_actions_frame, text='Apply suggested mutations',
                                             command=self.mutate_suggested)
         self.ui_mutations_actions_1 = tk.Button(self.ui_mutations_actions_frame, text='Apply selected mutation',
                                             command=self.mutate_selected)
+        self.ui_mutations_actions_2 = tk.Button(self.ui_mutations_actions_frame, text='Apply filtered mutations',
+                                            command=self.mutate_filtered)
+        self.ui_mutations_actions_3 = tk.Button(self.ui_mutations_actions_frame, text='Undo',
+                                            command=lambda: self.controller.undo())
+        self.ui_mutations_actions_4 = tk.Button(self.ui_mutations_actions_frame, text='Redo',
+                                            command=lambda: self.controller.redo())
+        # Ranking
+        self.ui_ranking_frame = tk.LabelFrame(master=self.canvas, text='Global ranking')
+        self.ui_ranking_table = SortableTable(self.ui_ranking_frame)
+        self.ui_ranking_actions_frame = tk.LabelFrame(self.canvas, text='Actions')
+        self.ui_ranking_k = tk.Spinbox(self.ui_ranking_actions_frame, from_=1, to=1000, width=5,
+                                       textvariable=self._ranking_k)
+        self.ui_ranking_actions_0 = tk.Button(self.ui_ranking_actions_frame, text='Top K stabilizing',
+                                              command=lambda: self.show_ranking(stabilizing=True))
+        self.ui_ranking_actions_1 = tk.Button(self.ui_ranking_actions_frame, text='Top K destabilizing',
+                                              command=lambda: self.show_ranking(stabilizing=False))
+        self.ui_ranking_actions_2 = tk.Button(self.ui_ranking_actions_frame, text='Apply selected mutations',
+                                              command=self.mutate_ranked)
+
+        # Heatmap
+        self.ui_heatmap_frame = tk.LabelFrame(master=self.canvas, text='ddG heatmap (residues x mutations)')
+        self.ui_heatmap = tk.Canvas(self.ui_heatmap_frame, height=20 * self.HEATMAP_CELL[1],
+                                    background=self.HEATMAP_MISSING, highlightthickness=0)
+        self.ui_heatmap_scroll = tk.Scrollbar(self.ui_heatmap_frame, orient='horizontal',
+                                              command=self.ui_heatmap.xview)
+        self.ui_heatmap.configure(xscrollcommand=self.ui_heatmap_scroll.set)
+        self.ui_heatmap.bind('<Button-1>', self.on_heatmap_click_cb)
+        self.ui_heatmap_label = tk.Label(self.ui_heatmap_frame, anchor='w')
+
+        # Comparison
+        self.ui_compare_frame = tk.LabelFrame(master=self.canvas, text='Comparison with other runs')
+        self.ui_compare_table = SortableTable(self.ui_compare_frame)
+        self.ui_compare_actions_frame = tk.LabelFrame(self.canvas, text='Actions')
+        self.ui_compare_actions_0 = tk.Button(self.ui_compare_actions_frame, text='Compare with run...',
+                                              command=self.compare_with)
+        self.ui_compare_actions_1 = tk.Button(self.ui_compare_actions_frame, text='Color by delta ddG',
+                                              command=self.color_by_delta)
+
+        # Hotspots
+        self.ui_hotspots_frame = tk.LabelFrame(master=self.canvas, text='Spatial hotspots')
+        self.ui_hotspots_table = SortableTable(self.ui_hotspots_frame)
+        self.ui_hotspots_actions_frame = tk.LabelFrame(self.canvas, text='Actions')
+        tk.Label(self.ui_hotspots_actions_frame, text='Radius (A)').pack(padx=5)
+        self.ui_hotspots_radius = tk.Spinbox(self.ui_hotspots_actions_frame, from_=2, to=30, width=5,
+                                             increment=0.5, textvariable=self._hotspots_radius)
+        self.ui_hotspots_actions_0 = tk.Button(self.ui_hotspots_actions_frame, text='Stabilizing hotspots',
+                                               command=lambda: self.find_hotspots(stabilizing=True))
+        self.ui_hotspots_actions_1 = tk.Button(self.ui_hotspots_actions_frame, text='Destabilizing hotspots',
+                                               command=lambda: self.find_hotspots(stabilizing=False))
+
         # Pack and grid
         self.ui_summary_frame.grid(row=0, column=0, sticky='news', padx=5, pady=5)
+        self.ui_search_frame.pack(fill='x', padx=5, pady=5)
+        self.ui_search_entry.pack(side='left', expand=True, fill='x', padx=5)
+        self.ui_search_label.pack(side='left')
         self.ui_summary_table.pack(expand=True, fill='both', padx=5, pady=5)
         self.ui_summary_actions_frame.grid(row=0, column=1, sticky='news', padx=5, pady=5)
         self.ui_summary_actions_0.pack(padx=5, pady=5, fill='x')
         self.ui_summary_actions_1.pack(padx=5, pady=5, fill='x')
         self.ui_summary_actions_2.pack(padx=5, pady=5, fill='x')
+        self.ui_summary_actions_3.pack(padx=5, pady=5, fill='x')
 
         self.ui_mutations_frame.grid(row=1, column=0, sticky='news', padx=5, pady=5)
+        self.ui_filter_frame.pack(fill='x', padx=5, pady=5)
+        self.ui_filter_entry.pack(side='left', expand=True, fill='x')
+        self.ui_filter_btn.pack(side='left', padx=5)
         self.ui_mutations_table.pack(expand=True, fill='both', padx=5, pady=5)
         self.ui_mutations_actions_frame.grid(row=1, column=1, sticky='news', padx=5, pady=5)
         self.ui_mutations_actions_0.pack(padx=5, pady=5, fill='x')
         self.ui_mutations_actions_1.pack(padx=5, pady=5, fill='x')
+        self.ui_mutations_actions_2.pack(padx=5, pady=5, fill='x')
+        self.ui_mutations_actions_3.pack(padx=5, pady=5, fill='x')
+        self.ui_mutations_actions_4.pack(padx=5, pady=5, fill='x')
+
+        self.ui_ranking_frame.grid(row=2, column=0, sticky='news', padx=5, pady=5)
+        self.ui_ranking_table.pack(expand=True, fill='both', padx=5, pady=5)
+        self.ui_ranking_actions_frame.grid(row=2, column=1, sticky='news', padx=5, pady=5)
+        self.ui_ranking_k.pack(padx=5, pady=5)
+        self.ui_ranking_actions_0.pack(padx=5, pady=5, fill='x')
+        self.ui_ranking_actions_1.pack(padx=5, pady=5, fill='x')
+        self.ui_ranking_actions_2.pack(padx=5, pady=5, fill='x')
+
+        self.ui_heatmap_frame.grid(row=3, column=0, columnspan=2, sticky='news', padx=5, pady=5)
+        self.ui_heatmap.pack(expand=True, fill='x', padx=5)
+        self.ui_heatmap_scroll.pack(fill='x', padx=5)
+        self.ui_heatmap_label.pack(fill='x', padx=5, pady=2)
+
+        self.ui_compare_frame.grid(row=4, column=0, sticky='news', padx=5, pady=5)
+        self.ui_compare_table.pack(expand=True, fill='both', padx=5, pady=5)
+        self.ui_compare_actions_frame.grid(row=4, column=1, sticky='news', padx=5, pady=5)
+        self.ui_compare_actions_0.pack(padx=5, pady=5, fill='x')
+        self.ui_compare_actions_1.pack(padx=5, pady=5, fill='x')
+
+        self.ui_hotspots_frame.grid(row=5, column=0, sticky='news', padx=5, pady=5)
+        self.ui_hotspots_table.pack(expand=True, fill='both', padx=5, pady=5)
+        self.ui_hotspots_actions_frame.grid(row=5, column=1, sticky='news', padx=5, pady=5)
+        self.ui_hotspots_radius.pack(padx=5, pady=5)
+        self.ui_hotspots_actions_0.pack(padx=5, pady=5, fill='x')
+        self.ui_hotspots_actions_1.pack(padx=5, pady=5, fill='x')
 
 
     def fillInData(self, data):
@@ -170,25 +343,31 @@ class PoPMuSiCResultsDialog(TangramBaseDialog):
             lambda: self.color_table(self.ui_mutations_table, self._color_mutations_table))
         self.ui_summary_table._callbacks.append(
             lambda: self.color_table(self.ui_summary_table, self._color_summary_table))
+        self.ui_summary_table._callbacks.append(self._forget_displayed)
         # Go!
         self._populate()
 
+    @staticmethod
+    def _summary_entry(i, res):
+        key = ResidueKey(res.chain, res.id, res.residue_type)
+        return [i+1, key, res.solvent_accessibility, res.ddG, res.negative_score, res.positive_score]
+
     def _populate(self, data=None):
         if data is None:
             data = self._data
 
         summary, mutations, keys = [], {}, []
         for i, res in enumerate(data):
-            entry = [i+1]
-            key = ':{}.{} {}'.format(res.id, res.chain, res.residue_type)
-            entry.append(key)
-            entry.append(res.solvent_accessibility)
-            entry.extend([res.ddG, res.negative_score, res.positive_score])
+            entry = self._summary_entry(i, res)
+            key = entry[1]
             summary.append(entry)
             keys.append(key)
             mutations[key] = res.mutations
 
         # Summary
+        self._summary = summary
+        self._displayed = None
+        self._search_index = ResidueIndex(keys)
         self._init_summary()
         self.ui_summary_table.setData(summary)
         try:
@@ -202,13 +381,76 @@ class PoPMuSiCResultsDialog(TangramBaseDialog):
         self._init_mutations(keys)
         self._mutations = mutations
 
+        # Ranking
+        self._init_ranking()
+        self.show_ranking(stabilizing=True)
+        self._schedule_prefetch(None)
+
+        # Heatmap
+        self.draw_heatmap()
+
+        # Comparison
+        self._init_compare()
+
+        # Hotspots
+        self._init_hotspots()
+
+    def apply_diff(self, data, diff):
+        """
+        Update the dialog after the model was reloaded, re-rendering only
+        the summary rows that changed (or everything, if residues were
+        added or removed).
+
+        Parameters
+        ----------
+        data : list of NamedResidue
+            The reloaded model
+        diff : core.ResultsDiff
+        """
+        self._data = data
+        self._displayed = None
+        if diff.added or diff.removed:
+            self._summary, self._mutations = [], {}
+            for i, res in enumerate(data):
+                entry = self._summary_entry(i, res)
+                self._summary.append(entry)
+                self._mutations[entry[1]] = res.mutations
+            self._sorted_summary = None
+            self._search_index = ResidueIndex([entry[1] for entry in self._summary])
+            self.ui_summary_table.setData(self._summary)
+            self.ui_summary_table.refresh(rebuild=True)
+        elif diff.changed:
+            changed = set(diff.changed)
+            # Rows as currently displayed; the model permutations are already the new ones
+            shown = self._sorted_summary[1] if self._sorted_summary else self.ui_summary_table._sortedData()
+            positions = {id(entry): i for i, entry in enumerate(shown)}
+            hlist = self.ui_summary_table.tixTable.subwidget_list['hlist']
+            for i, res in enumerate(data):
+                if (res.chain, res.id) not in changed:
+                    continue
+                entry = self._summary[i]
+                entry[:] = self._summary_entry(i, res)
+                self._mutations[entry[1]] = res.mutations
+                row = positions[id(entry)]
+                for j, value in enumerate(entry):
+                    hlist.item_configure(row, j, text=str(value) if j < 2 else '%.2f' % value)
+                self.color_table(self.ui_summary_table, self._color_summary_table, rows=[row])
+            if self._sorted_summary is not None:  # Values changed, so may the order
+                self.ui_summary_table.refresh()
+        self._row_cache.clear()
+        if self._selected_key in self._mutations:
+            self._populate_mutations(self._selected_key)
+        self.show_ranking(stabilizing=self._ranking_stabilizing)
+        self.draw_heatmap()
+
     def _init_summary(self):
         columns = ['#', 'Residue', 'Solvent Accessibility', 'ddG', 'Neg. score', 'Pos. score']
         for i, column in enumerate(columns):
             font, anchor, format_ = 'TkTextFont', 'center', '%s'
             if i > 1:
                 font, anchor, format_ = ('Courier', 10), 'e', '%.2f'
-            self.ui_summary_table.addColumn(column, itemgetter(i), font=font, anchor=anchor,
+            getter = (lambda row: str(row[1])) if i == 1 else itemgetter(i)
+            self.ui_summary_table.addColumn(column, getter, font=font, anchor=anchor,
                                          headerAnchor='center', format=format_)
 
     def _init_mutations(self, residues):
@@ -218,13 +460,115 @@ class PoPMuSiCResultsDialog(TangramBaseDialog):
                                          headerAnchor='center', format=format_)
         self.ui_mutations_table.addColumn('ddG', itemgetter(2), font=font, anchor=anchor,
                                          headerAnchor='center', format=format_)
+        self.ui_mutations_table.addColumn('Residue', lambda row: str(row[3]))
         self.ui_mutations_table.setData([])
         self.ui_mutations_table.launch(selectMode="single")
 
+    def _init_ranking(self):
+        font, anchor, format_ = ('Courier', 10), 'e', '%.2f'
+        self.ui_ranking_table.addColumn('Rank', itemgetter(0))
+        self.ui_ranking_table.addColumn('Residue', lambda row: str(row[1]))
+        self.ui_ranking_table.addColumn('Mutation', itemgetter(2))
+        self.ui_ranking_table.addColumn('ddG', itemgetter(3), font=font, anchor=anchor,
+                                        headerAnchor='center', format=format_)
+        self.ui_ranking_table.setData([])
+        self.ui_ranking_table.launch(selectMode='extended')
+
+    def _init_compare(self):
+        font, anchor, format_ = ('Courier', 10), 'e', '%.2f'
+        self.ui_compare_table.addColumn('Residue', itemgetter(0))
+        self.ui_compare_table.addColumn('Mutation', itemgetter(1))
+        for i, name in enumerate(('ddG (current)', 'ddG (other)', 'Delta ddG')):
+            self.ui_compare_table.addColumn(name, itemgetter(i + 2), font=font, anchor=anchor,
+                                            headerAnchor='center', format=format_)
+        self.ui_compare_table.setData([])
+        self.ui_compare_table.launch(selectMode='single')
+
+    def _init_hotspots(self):
+        self.ui_hotspots_table.addColumn('Cluster', itemgetter(0))
+        self.ui_hotspots_table.addColumn('Size', itemgetter(1))
+        self.ui_hotspots_table.addColumn('Score', itemgetter(2), font=('Courier', 10), anchor='e',
+                                         headerAnchor='center', format='%.2f')
+        self.ui_hotspots_table.addColumn('Residues', itemgetter(3))
+        self.ui_hotspots_table.setData([])
+        self.ui_hotspots_table.launch(selectMode='single')
+
     def _populate_mutations(self, key):
-        data = [(r, m[0], m[1]) for r, m in self._mutations[key].items()]
-        self.ui_mutations_table.setData(data)
-        self.ui_mutations_table.refresh(rebuild=True)
+        self._set_mutation_rows(self._mutation_rows_for(key))
+        self._schedule_prefetch(key)
+
+    def _mutation_rows_for(self, key):
+        """
+        Mutation table rows of residue `key`, from a small LRU cache
+        """
+        rows = self._row_cache.pop(key, None)
+        if rows is None:
+            rows = [(r, m[0], m[1], key) for r, m in self._mutations[key].items()]
+        self._row_cache[key] = rows  # Mark as recently used
+        while len(self._row_cache) > self.ROW_CACHE_SIZE:
+            self._row_cache.popitem(last=False)
+        return rows
+
+    def _schedule_prefetch(self, key):
+        if self._prefetch_job is not None:
+            self.canvas.after_cancel(self._prefetch_job)
+        self._prefetch_job = self.canvas.after_idle(self._prefetch, key)
+
+    def _prefetch(self, key):
+        """
+        Build the mutation rows of the residues shown around `key` in the
+        summary table (if given) and of the top ranked ones, so that moving
+        to them does not need to build anything.
+        """
+        self._prefetch_job = None
+        wanted = []
+        keys, positions = self._displayed_keys()
+        if key in positions:
+            i, n = positions[key], self.PREFETCH_NEIGHBOURS
+            wanted = keys[max(0, i - n):i] + keys[i + 1:i + n + 1]
+        wanted += [ResidueKey(m.chain, m.id, m.residue_wildtype) for m in self._ranked]
+        for k in wanted[:self.ROW_CACHE_SIZE - 1]:
+            if k not in self._row_cache and k in self._mutations:
+                self._mutation_rows_for(k)
+        if key in self._mutations:  # Keep it as the most recently used entry
+            self._mutation_rows_for(key)
+
+    def _displayed_keys(self):
+        """
+        Keys of the summary rows in display order, and {key: position}.
+        Cached until the summary table is sorted or refreshed.
+        """
+        if self._displayed is None:
+            keys = [entry[1] for entry in self.ui_summary_table._sortedData()]
+            self._displayed = keys, dict((k, i) for i, k in enumerate(keys))
+        return self._displayed
+
+    def _forget_displayed(self):
+        self._displayed = None
+
+    def _populate_filtered(self, mutations):
+        self._set_mutation_rows([[m.residue_mutated, m.sa, m.ddG,
+                                  ResidueKey(m.chain, m.id, m.residue_wildtype)]
+                                 for m in mutations])
+
+    def _set_mutation_rows(self, rows):
+        """
+        Show `rows` in the mutations table. If it already holds the same number
+        of rows, their contents are replaced in place and the table is only
+        refreshed, instead of rebuilt. The selection is cleared in both cases,
+        since it would now point to a mutation of another residue.
+        """
+        table = self.ui_mutations_table
+        if self._mutation_rows and len(rows) == len(self._mutation_rows):
+            for row, new in zip(self._mutation_rows, rows):
+                row[:] = new
+            if table.tixTable is not None:
+                table.tixTable.subwidget_list['hlist'].selection_clear()
+            table.refresh()
+        else:
+            self._mutation_rows = rows = [list(row) for row in rows]
+            table.setData(rows)
+            table.refresh(rebuild=True)
 
     @staticmethod
     def _color_summary_table(row):
@@ -235,73 +579,258 @@ class PoPMuSiCResultsDialog(TangramBaseDialog):
 
     @staticmethod
     def _color_mutations_table(row):
-        ddg = row[-1]
+        ddg = row[2]
         if ddg < 0:
             return 'ForestGreen'
 
     # Callbacks
     def on_selection_cb(self, selected):
+        """
+        Defer rendering `selected` by SELECTION_DELAY ms, so a burst of
+        selections (e.g. holding an arrow key) only renders the last one.
+        """
+        self._pending_selection = selected
+        if self._selection_job is not None:
+            self.canvas.after_cancel(self._selection_job)
+        self._selection_job = self.canvas.after(self.SELECTION_DELAY, self._flush_selection)
+
+    def _flush_selection(self):
+        self._selection_job = None
+        selected, self._pending_selection = self._pending_selection, None
+        if selected is not None:
+            self.select_residue(selected)
+
+    def select_residue(self, selected):
+        """
+        Show the mutations of summary row `selected` and display its atoms
+        """
         key = selected[1] # Residue info is in 2nd cell
+        self._selected_key = key
         self._populate_mutations(key)
-        # Parse the residue number from key :123.A ASP, where 123 is what we want
-        residue = next(r for r in self.molecule.residues if r.id.position == int(key.split('.')[0][1:]))
-        if self._previously_selected_residue:
-            for a in self._previously_selected_residue.atoms:
-                a.display = False
-        self._previously_selected_residue = residue
-        for a in residue.atoms:
-            a.display = True
+        self._show_residue(self.controller.find_residue(key.chain, key.id))
+
+    def _show_residue(self, residue):
+        """
+        Display the atoms of `residue` and hide those of the previously
+        shown one, touching only the atoms whose state changes.
+        """
+        previous, self._previously_selected_residue = self._previously_selected_residue, residue
+        if residue is previous:
+            return
+        shown = set(residue.atoms) if residue is not None else set()
+        if previous is not None:
+            for a in previous.atoms:
+                if a not in shown:
+                    a.display = False
+        for a in shown:
+            if not a.display:
+                a.display = True
+
+    def on_heatmap_click_cb(self, event):
+        matrix = self.controller.model.matrix
+        if matrix is None:
+            return
+        width, height = self.HEATMAP_CELL
+        i = int(self.ui_heatmap.canvasx(event.x) // width)
+        j = int(self.ui_heatmap.canvasy(event.y) // height)
+        n, m = matrix.shape
+        if not (0 <= i < n and 0 <= j < m):
+            return
+        (chain, position), mutation, ddg = matrix.cell(i, j)
+        self.ui_heatmap_label.configure(text='{}.{} {} -> {}: {:.2f}'.format(
+            position, chain, self._summary[i][1].residue_type, mutation, ddg))
+        row = self._summary[i]
+        self.ui_summary_table.select(row)
+        self.select_residue(row)
+        for mrow in self._mutation_rows:
+            if mrow[0] == mutation:
+                self.ui_mutations_table.select(mrow)
+                break
+
+    def draw_heatmap(self):
+        """
+        Render the residue x mutation ddG matrix as a single image,
+        with residues along the x axis and mutations along the y axis.
+        """
+        matrix = self.controller.model.matrix
+        if matrix is None or not matrix.residues:
+            return
+        values = matrix.values.T
+        limit = np.nanmax(np.abs(values)) if not np.isnan(values).all() else 1.
+        lut = coloring.get_lut('Blue-Red')
+        indices = lut.indices(values.ravel(), vmin=-limit, vmax=limit).reshape(values.shape)
+        palette = np.array(lut.hex + [self.HEATMAP_MISSING])  # index -1 -> missing
+        pixels = palette[indices].tolist()
+        image = tk.PhotoImage(master=self.ui_heatmap, width=values.shape[1], height=values.shape[0])
+        image.put(' '.join('{' + ' '.join(row) + '}' for row in pixels))
+        width, height = self.HEATMAP_CELL
+        self._heatmap_image = image.zoom(width, height)
+        self.ui_heatmap.delete('all')
+        self.ui_heatmap.create_image(0, 0, anchor='nw', image=self._heatmap_image)
+        self.ui_heatmap.configure(scrollregion=(0, 0, values.shape[1] * width, values.shape[0] * height))
+
+    def compare_with(self):
+        pops = askopenfilename(title='Select .pops file of the other run')
+        pop = askopenfilename(title='Select .pop file of the other run') if pops else None
+        if not (pops and pop):
+            return
+        self._comparison = comparison = self.controller.compare_with([(pops, pop)])
+        data = [(':{}.{}'.format(position, chain), mutant, ref, other, delta)
+                for (chain, position, mutant, ref, other, delta) in comparison.rows(run=-1)]
+        self.ui_compare_frame.configure(text='Comparison: {} vs {}'.format(*comparison.labels[:2]))
+        self.ui_compare_table.setData(data)
+        self.ui_compare_table.refresh(rebuild=True)
+
+    def color_by_delta(self):
+        if self._comparison is None:
+            return
+        comparison = self._comparison
+        residues = [self.controller.find_residue(*key) for key in comparison.residue_keys]
+        values = comparison.residue_delta[:, -1]
+        limit = np.nanmax(np.abs(values)) if not np.isnan(values).all() else 1.
+        pairs = [(r, v) for r, v in zip(residues, values) if r is not None]
+        coloring.color_residues([r for r, _ in pairs], [v for _, v in pairs], palette='Blue-Red',
+                                vmin=-limit, vmax=limit)
+
+    def find_hotspots(self, stabilizing=True):
+        try:
+            radius = float(self._hotspots_radius.get())
+        except (ValueError, tk.TclError):
+            radius = 8.0
+        hotspots = self.controller.find_hotspots(radius=radius, stabilizing=stabilizing)
+        data = [(i+1, len(h.residues), h.score,
+                 ' '.join(':{}.{}'.format(position, chain) for chain, position in h.residues))
+                for i, h in enumerate(hotspots)]
+        self.ui_hotspots_table.setData(data)
+        self.ui_hotspots_table.refresh(rebuild=True)
+        self.controller.color_hotspots(hotspots)
+
+    def toggle_watch(self):
+        if self._watch.get():
+            self.controller.watch()
+        else:
+            self.controller.unwatch()
+
+    def Close(self):
+        if self.controller is not None:
+            self.controller.unwatch()
+        for job in (self._selection_job, self._prefetch_job):
+            if job is not None:
+                self.canvas.after_cancel(job)
+        self._selection_job = self._prefetch_job = None
+        super(PoPMuSiCResultsDialog, self).Close()
 
     def color_by_ddg(self):
-        self.render_by_attr('popmusic_ddG', colormap='Rainbow')
+        self.controller.color_by('ddG', palette='Rainbow')
 
     def color_by_sasa(self):
-        self.render_by_attr('popmusic_solvent_accessibility', colormap='Rainbow')
-
-    def render_by_attr(self, attr, colormap='Blue-Red', histogram_values=None):
-        if self._show_attr_dialog is None:
-            self._show_attr_dialog = ShowAttrDialog()
-        d = self._show_attr_dialog
-        d.enter()
-        d.configure(models=[self.molecule], attrsOf='residues', attrName=attr)
-        if isinstance(histogram_values, list) and len(histogram_values) == 2:
-            d.histogram()['datasource'] = histogram_values + [lambda n: d._makeBins(n, 'Render')]
-        d.colorAtomsVar.set(0)
-        d.setPalette(colormap)
-        d.paletteMenu.setvalue(colormap)
-        d.paletteMenu.invoke()
-        # Let the histogram end its calculations; otherwise errors will ocurr
-        d.uiMaster().after(500, d.Apply)
+        self.controller.color_by('solvent_accessibility', palette='Rainbow')
 
     def reset_colors(self):
-        for r in self.molecule.residues:
-            r.ribbonColor = None
+        self.controller.reset_colors()
 
     def mutate_suggested(self):
         self.controller.apply_favourable_mutations(conservative=True)
 
     def mutate_selected(self):
-        # Get 2nd cell, and parse residue number
-        resnum = int(self.ui_summary_table.selected()[1].split('.')[0][1:])
-        mutation = self.ui_mutations_table.selected()[0]  # Mutation is 1st cell
-        residue = self.molecule.findResidue(resnum)
-        self.controller.apply_mutation(residue, mutation, criteria='chp')
+        selected = self.ui_mutations_table.selected()
+        if not selected:
+            return
+        # 4th cell of the mutation holds the ResidueKey
+        mutation, _, _, key = selected
+        residue = self.controller.find_residue(key.chain, key.id)
+        self.controller.mutate(residue, mutation, criteria='chp')
+
+    def show_ranking(self, stabilizing=True):
+        self._ranking_stabilizing = stabilizing
+        try:
+            k = int(self._ranking_k.get())
+        except (ValueError, tk.TclError):
+            k = 10
+        self._ranked = self.controller.model.top_mutations(k, stabilizing=stabilizing)
+        data = [(i+1, ResidueKey(m.chain, m.id, m.residue_wildtype), m.residue_mutated, m.ddG, m)
+                for i, m in enumerate(self._ranked)]
+        self.ui_ranking_table.setData(data)
+        self.ui_ranking_table.refresh(rebuild=True)
+
+    def mutate_ranked(self):
+        selected = self.ui_ranking_table.selected()
+        if selected:
+            self.controller.apply_mutations([row[-1] for row in selected], criteria='chp')
+
+    def filter_mutations(self):
+        text = self._filter.get().strip()
+        if not text:
+            self._filtered = []
+            self._set_mutation_rows([])
+            return
+        try:
+            self._filtered = self.controller.model.query(text)
+        except (ValueError, KeyError, TypeError) as e:
+            raise chimera.UserError(str(e))
+        self._populate_filtered(self._filtered)
+
+    def search_residue(self, step=0):
+        """
+        Select the first summary row matching the search box, or move
+        `step` matches forward (or backward) from the current one.
+        """
+        if step:
+            if not len(self._search_hits):
+                return
+            self._search_hit = (self._search_hit + step) % len(self._search_hits)
+        else:
+            text = self._search.get().strip()
+            found = self._search_index.search(text) if text and self._search_index else []
+            self._search_hits, self._search_hit = found, 0
+        if not len(self._search_hits):
+            self.ui_search_label.configure(text='0/0' if self._search.get().strip() else '')
+            return
+        self.ui_search_label.configure(text='{}/{}'.format(self._search_hit + 1, len(self._search_hits)))
+        row = self._summary[self._search_hits[self._search_hit]]
+        self.ui_summary_table.select(row)
+        self.on_selection_cb(row)
+
+    def mutate_filtered(self):
+        if self._filtered:
+            self.controller.apply_mutations(self._filtered, criteria='chp')
 
-    def color_table(self, table, color):
+    def color_table(self, table, color, rows=None):
         if table.tixTable is None:
             return
-        for i, row in enumerate(table._sortedData()):
-            row_color = color(row)
+        data = table._sortedData()
+        for i in (range(len(data)) if rows is None else rows):
+            row_color = color(data[i])
             if not row_color:
-                continue
+                if rows is None:
+                    continue
+                row_color = 'black'
             for j, col in enumerate(table.columns):
-                col_style = {'anchor': getattr(col, 'anchor', None),
-                             'wraplength': getattr(col, 'wrapLength', None),
-                             'padx': col.textStyle['padx'],
-                             'pady': col.textStyle['pady'],
-                             'font': (col.fontFamily, col.fontSize)}
-                style = Tix.DisplayStyle('text', foreground=row_color, **col_style)
-                table.tixTable.subwidget_list['hlist'].item_configure(i, j, style=style)
+                table.tixTable.subwidget_list['hlist'].item_configure(
+                    i, j, style=self._cell_style(table, j, col, row_color))
+
+    def _cell_style(self, table, j, col, color):
+        """
+        Tix style of column `j` of `table` in `color`, created only once
+        """
+        key = id(table), j, color
+        style = self._styles.get(key)
+        if style is None:
+            col_style = {'anchor': getattr(col, 'anchor', None),
+                         'wraplength': getattr(col, 'wrapLength', None),
+                         'padx': col.textStyle['padx'],
+                         'pady': col.textStyle['pady'],
+                         'font': (col.fontFamily, col.fontSize)}
+            style = self._styles[key] = Tix.DisplayStyle('text', foreground=color, **col_style)
+        return style
+
+    def _summary_sort_field(self, table):
+        """
+        Model field whose permutation sorts the summary table by its
+        current sort column, or None
+        """
+        if self._sort_column in table.columns:
+            return self.SUMMARY_SORT_FIELDS.get(table.columns.index(self._sort_column))
 
     def _table_monkey_patches(self):
         """
@@ -322,3 +851,28 @@ class PoPMuSiCResultsDialog(TangramBaseDialog):
         # Bound the patched refresh to the instance with `types.MethodType`
         self.ui_mutations_table.refresh = types.MethodType(patched_refresh, self.ui_mutations_table)
         self.ui_summary_table.refresh = types.MethodType(patched_refresh, self.ui_summary_table)
+
+        # Sort the summary table by numeric columns with the permutations
+        # precomputed by the model, instead of comparing rows
+        summary = self.ui_summary_table
+        summary._old_sortBy = summary.sortBy
+        summary._old_sortedData = summary._sortedData
+        def patched_sortBy(obj, column, *args, **kwargs):
+            self._sort_descending = column is self._sort_column and not self._sort_descending
+            self._sort_column = column
+            self._displayed = None
+            if self._summary_sort_field(obj) is None:
+                self._sorted_summary = None  # Not sorted by a model permutation anymore
+            return obj._old_sortBy(column, *args, **kwargs)
+        def patched_sortedData(obj):
+            orders = self.controller.model.sort_orders
+            field = self._summary_sort_field(obj)
+            if field is None or orders is None or obj.data is not self._summary:
+                self._sorted_summary = None
+                return obj._old_sortedData()
+            key = orders, field, self._sort_descending
+            if self._sorted_summary is None or self._sorted_summary[0] != key:
+                self._sorted_summary = key, orders.sorted(self._summary, field, self._sort_descending)
+            return self._sorted_summary[1]
+        summary.sortBy = types.MethodType(patched_sortBy, summary)
+        summary._sortedData = types.MethodType(patched_sortedData, summary)
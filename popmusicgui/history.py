@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Undo/redo of mutations through lightweight snapshots of the affected residues.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import contextlib
+# Chimera stuff
+import chimera
+# Additional 3rd parties
+import numpy as np
+# Own
+from spatial import atom_coordinates
+
+
+class ResidueSnapshot(object):
+
+    """
+    Compact copy of a residue: type, atom names, elements, coordinates
+    and intra-residue bonds, stored as arrays.
+    """
+
+    __slots__ = ('residue', 'type', 'names', 'elements', 'coords', 'bonds')
+
+    def __init__(self, residue):
+        atoms = residue.atoms
+        index = dict((a, i) for i, a in enumerate(atoms))
+        self.residue = residue
+        self.type = residue.type
+        self.names = [a.name for a in atoms]
+        self.elements = np.array([a.element.number for a in atoms], dtype=np.uint8)
+        self.coords = np.asarray(atom_coordinates(atoms), dtype=np.float32)
+        bonds = set()
+        for a in atoms:
+            for b in a.bonds:
+                i, j = index.get(b.atoms[0]), index.get(b.atoms[1])
+                if i is not None and j is not None:
+                    bonds.add((min(i, j), max(i, j)))
+        self.bonds = np.array(sorted(bonds), dtype=np.uint16).reshape(-1, 2)
+
+    def restore(self):
+        """
+        Bring the residue back to this snapshot. Atoms present in both
+        states are kept (so bonds to other residues survive); the rest are
+        deleted or created.
+        """
+        residue, molecule = self.residue, self.residue.molecule
+        current = dict((a.name, a) for a in residue.atoms)
+        wanted = dict(zip(self.names, self.elements.tolist()))
+        for name, atom in list(current.items()):
+            if wanted.get(name) != atom.element.number:
+                molecule.deleteAtom(atom)
+                del current[name]
+        atoms = []
+        for name, element, xyz in zip(self.names, self.elements.tolist(), self.coords.tolist()):
+            atom = current.get(name)
+            if atom is None:
+                atom = molecule.newAtom(name, chimera.Element(element))
+                residue.addAtom(atom)
+            atom.setCoord(chimera.Point(*xyz))
+            atoms.append(atom)
+        for i, j in self.bonds.tolist():
+            if atoms[j] not in atoms[i].bondsMap:
+                molecule.newBond(atoms[i], atoms[j])
+        residue.type = self.type
+        for atom in atoms:
+            atom.display = True
+
+
+class MutationHistory(object):
+
+    """
+    Multi-level undo/redo stack of mutation transactions.
+
+    Parameters
+    ----------
+    maxlen : int, optional
+        Maximum number of transactions kept for undo
+    """
+
+    def __init__(self, maxlen=50):
+        self.maxlen = maxlen
+        self._undo = []
+        self._redo = []
+
+    def can_undo(self):
+        return bool(self._undo)
+
+    def can_redo(self):
+        return bool(self._redo)
+
+    @contextlib.contextmanager
+    def transaction(self, residues):
+        """
+        Snapshot `residues` before the enclosed block modifies them.
+        If the block fails, the residues are restored and the error re-raised.
+        """
+        snapshots = [ResidueSnapshot(r) for r in residues]
+        try:
+            yield
+        except Exception:
+            for snapshot in reversed(snapshots):
+                snapshot.restore()
+            raise
+        if snapshots:
+            self._undo.append(snapshots)
+            del self._undo[:-self.maxlen]
+            self._redo = []
+
+    def undo(self):
+        """
+        Revert the last transaction. Returns the affected residues.
+        """
+        return self._swap(self._undo, self._redo)
+
+    def redo(self):
+        """
+        Re-apply the last undone transaction. Returns the affected residues.
+        """
+        return self._swap(self._redo, self._undo)
+
+    @staticmethod
+    def _swap(source, target):
+        if not source:
+            return []
+        snapshots = source.pop()
+        target.append([ResidueSnapshot(s.residue) for s in snapshots])
+        for snapshot in reversed(snapshots):
+            snapshot.restore()
+        return [s.residue for s in snapshots]
@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Batch submission of structures to a PoPMuSiC-like service.
+
+`JobManager` queues structures and runs them through a pluggable backend
+with bounded concurrency and a submission rate limit. It polls each job
+until it finishes and downloads the .pops/.pop pair into a cache keyed by
+the structure contents, so resubmitting an identical structure is free.
+
+Backends implement `JobBackend`. `HTTPBackend` talks to a small REST API
+(POST /jobs, GET /jobs/<id>, GET /jobs/<id>/pops, GET /jobs/<id>/pop),
+which `LocalServer` serves locally on top of `MockBackend` for testing::
+
+    with LocalServer(MockBackend(delay=1)) as server:
+        manager = JobManager(HTTPBackend(server.url), concurrency=4, rate=2)
+        for path in structures:
+            manager.submit(path)
+        models = [job.load() for job in manager.wait() if job.state == 'done']
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+import errno
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+try:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from Queue import Queue
+    from urllib2 import Request, urlopen
+except ImportError:  # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from queue import Queue
+    from urllib.request import Request, urlopen
+# Own
+from columns import AMINO_ACIDS
+from content import file_hash
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'), '.tangram_popmusic_jobs')
+STATES = ('queued', 'submitted', 'running', 'done', 'failed')
+
+
+def structure_hash(path):
+    """
+    SHA1 of the contents of a structure file
+    """
+    return file_hash(path).hexdigest()
+
+
+class Job(object):
+
+    """
+    A structure to be processed, and the outcome once finished.
+
+    Attributes
+    ----------
+    state : str
+        One of `STATES`
+    pops, pop : str
+        Paths to the cached results, once `state` is 'done'
+    cached : bool
+        True if the results were already in the cache
+    duplicate_of : Job or None
+        Job of an identical structure that was already in flight when
+        this one was submitted, and whose outcome this one shares
+    """
+
+    def __init__(self, structure):
+        self.structure = structure
+        self.hash = structure_hash(structure)
+        self.id = None
+        self.state = 'queued'
+        self.error = None
+        self.pops = self.pop = None
+        self.cached = False
+        self.duplicate_of = None
+        self.finished = threading.Event()
+
+    def __repr__(self):
+        return '<Job {} {}>'.format(os.path.basename(self.structure), self.state)
+
+    def load(self, merge_chains=False):
+        """
+        Parse the downloaded results into a new `core.Model`
+        """
+        from core import Model
+        if self.state != 'done':
+            raise ValueError('Job {} is {}'.format(self.structure, self.state))
+        model = Model(gui=None)
+        model.parse_files(self.pops, self.pop, merge_chains=merge_chains)
+        return model
+
+
+class JobBackend(object):
+
+    """
+    Interface of the services `JobManager` submits to
+    """
+
+    def submit(self, structure):
+        """
+        Send the structure file and return a job id
+        """
+        raise NotImplementedError
+
+    def status(self, job_id):
+        """
+        One of 'submitted', 'running', 'done' or 'failed'
+        """
+        raise NotImplementedError
+
+    def download(self, job_id, pops, pop):
+        """
+        Save the results of a finished job to the `pops` and `pop` paths
+        """
+        raise NotImplementedError
+
+
+class MockBackend(JobBackend):
+
+    """
+    In-process stand-in for the PoPMuSiC service. Jobs finish after `delay`
+    seconds with made-up (but deterministic, per structure) results for
+    every residue with an alpha carbon.
+    """
+
+    def __init__(self, delay=1.0):
+        self.delay = delay
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, structure):
+        with open(structure, 'rb') as f:
+            contents = f.read()
+        with self._lock:
+            job_id = str(len(self._jobs) + 1)
+            self._jobs[job_id] = time.time(), contents
+        return job_id
+
+    def status(self, job_id):
+        if job_id not in self._jobs:
+            return 'failed'
+        return 'done' if time.time() - self._jobs[job_id][0] >= self.delay else 'running'
+
+    def download(self, job_id, pops, pop):
+        pops_text, pop_text = self.results(self._jobs[job_id][1])
+        for path, text in ((pops, pops_text), (pop, pop_text)):
+            with io.open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+
+    @staticmethod
+    def results(contents):
+        """
+        Fake .pops and .pop file contents for the PDB `contents` (bytes)
+        """
+        rng = random.Random(hashlib.sha1(contents).hexdigest())
+        summary, mutations = [u'# Chains considered: ALL\n'], [u'# Chains considered: ALL\n']
+        for line in contents.decode('utf-8', 'replace').splitlines():
+            if not line.startswith('ATOM') or line[12:16].strip() != 'CA':
+                continue
+            chain, position, wt = line[21].strip() or 'A', int(line[22:26]), line[17:20]
+            sa = rng.uniform(0, 100)
+            ddgs = [(mt, round(rng.gauss(0.8, 0.7), 2)) for mt in AMINO_ACIDS if mt != wt]
+            for mt, ddg in ddgs:
+                mutations.append(u'{} {:>4}  {} {} C {:6.2f} {:6.2f}\n'.format(chain, position, wt, mt, sa, ddg))
+            values = [ddg for _, ddg in ddgs]
+            summary.append(u'{} {:>4}  {} C {:6.2f} {:6.2f} {:6.2f} {:6.2f}\n'.format(
+                chain, position, wt, sa, sum(values) / len(values),
+                sum(v for v in values if v < 0), sum(v for v in values if v > 0)))
+        return u''.join(summary), u''.join(mutations)
+
+
+class HTTPBackend(JobBackend):
+
+    """
+    Client of the REST API served by `LocalServer`
+
+    Parameters
+    ----------
+    url : str
+        Base URL of the service
+    timeout : float, optional
+        Seconds to wait for each request
+    """
+
+    def __init__(self, url, timeout=30):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, path, data=None, headers=None):
+        request = Request(self.url + path, data=data, headers=headers or {})
+        response = urlopen(request, timeout=self.timeout)
+        try:
+            return response.read()
+        finally:
+            response.close()
+
+    def submit(self, structure):
+        with open(structure, 'rb') as f:
+            data = f.read()
+        reply = self._request('/jobs', data=data, headers={'X-Filename': os.path.basename(structure)})
+        return json.loads(reply.decode('utf-8'))['id']
+
+    def status(self, job_id):
+        return json.loads(self._request('/jobs/' + job_id).decode('utf-8'))['state']
+
+    def download(self, job_id, pops, pop):
+        for path, kind in ((pops, 'pops'), (pop, 'pop')):
+            data = self._request('/jobs/{}/{}'.format(job_id, kind))
+            with open(path, 'wb') as f:
+                f.write(data)
+
+
+class LocalServer(object):
+
+    """
+    Serve a `JobBackend` (a `MockBackend` by default) over HTTP from a
+    background thread, on localhost. Use `url` with `HTTPBackend`.
+    """
+
+    def __init__(self, backend=None, host='127.0.0.1', port=0):
+        self.backend = backend if backend is not None else MockBackend()
+        self._server = _ThreadingHTTPServer((host, port), _Handler)
+        self._server.backend = self.backend
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            return self.send_error(404)
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        fd, path = tempfile.mkstemp(suffix='_' + os.path.basename(self.headers.get('X-Filename', 'job.pdb')))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            job_id = self.server.backend.submit(path)
+        finally:
+            os.remove(path)
+        self._reply(json.dumps({'id': job_id}).encode('utf-8'), 'application/json')
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'jobs':
+            state = self.server.backend.status(parts[1])
+            return self._reply(json.dumps({'state': state}).encode('utf-8'), 'application/json')
+        if len(parts) == 3 and parts[0] == 'jobs' and parts[2] in ('pops', 'pop'):
+            if self.server.backend.status(parts[1]) != 'done':
+                return self.send_error(409, 'Job not finished')
+            directory = tempfile.mkdtemp(prefix='popmusic_')
+            try:
+                pops, pop = os.path.join(directory, 'result.pops'), os.path.join(directory, 'result.pop')
+                self.server.backend.download(parts[1], pops, pop)
+                with open(pops if parts[2] == 'pops' else pop, 'rb') as f:
+                    data = f.read()
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+            return self._reply(data, 'text/plain')
+        self.send_error(404)
+
+    def _reply(self, data, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class JobManager(object):
+
+    """
+    Run structures through `backend` from a pool of worker threads.
+
+    Parameters
+    ----------
+    backend : JobBackend
+    cache_dir : str, optional
+        Results are stored in `<cache_dir>/<structure sha1>/result.pop(s)`
+    concurrency : int, optional
+        Maximum number of jobs in flight
+    rate : float, optional
+        Maximum submissions per second
+    poll_interval : float, optional
+        Seconds between status checks of each job
+    on_done : callable, optional
+        Called with each `Job` once it is done or failed, from a worker thread
+    """
+
+    def __init__(self, backend, cache_dir=DEFAULT_CACHE, concurrency=4, rate=1.0,
+                 poll_interval=5.0, on_done=None):
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.concurrency = concurrency
+        self.rate = rate
+        self.poll_interval = poll_interval
+        self.on_done = on_done
+        self.jobs = []
+        self._queue = Queue()
+        self._workers = []
+        self._rate_lock = threading.Lock()
+        self._next_submission = 0.0
+        self._lock = threading.Lock()
+        self._in_flight = {}  # {structure hash: [running job, duplicates...]}
+
+    def cache_paths(self, job):
+        directory = os.path.join(self.cache_dir, job.hash)
+        return os.path.join(directory, 'result.pops'), os.path.join(directory, 'result.pop')
+
+    def submit(self, structure):
+        """
+        Queue a structure file. Returns its `Job`. If an identical structure
+        is already queued or running, the new job is attached to it
+        instead of being sent again.
+        """
+        job = Job(structure)
+        with self._lock:
+            self.jobs.append(job)
+            in_flight = self._in_flight.setdefault(job.hash, [])
+            in_flight.append(job)
+            if len(in_flight) > 1:
+                job.duplicate_of = in_flight[0]
+                return job
+        self._queue.put(job)
+        while len(self._workers) < min(self.concurrency, len(self.jobs)):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        return job
+
+    def wait(self, timeout=None):
+        """
+        Block until every submitted job finished (or `timeout` seconds
+        passed). Returns the jobs.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for job in list(self.jobs):
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            job.finished.wait(remaining)
+        return self.jobs
+
+    def _throttle(self):
+        with self._rate_lock:
+            now = time.time()
+            wait = self._next_submission - now
+            self._next_submission = max(now, self._next_submission) + 1.0 / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._run(job)
+            except Exception as e:
+                job.state, job.error = 'failed', str(e)
+            finally:
+                with self._lock:
+                    duplicates = self._in_flight.pop(job.hash, [job])[1:]
+                self._finish(job)
+                for duplicate in duplicates:
+                    duplicate.id, duplicate.state, duplicate.error = job.id, job.state, job.error
+                    duplicate.pops, duplicate.pop, duplicate.cached = job.pops, job.pop, job.cached
+                    self._finish(duplicate)
+                self._queue.task_done()
+
+    def _finish(self, job):
+        job.finished.set()
+        if self.on_done is not None:
+            try:
+                self.on_done(job)
+            except Exception:
+                traceback.print_exc()
+
+    def _run(self, job):
+        pops, pop = self.cache_paths(job)
+        if os.path.isfile(pops) and os.path.isfile(pop):
+            job.pops, job.pop, job.cached, job.state = pops, pop, True, 'done'
+            return
+        self._throttle()
+        job.id = self.backend.submit(job.structure)
+        job.state = 'submitted'
+        while True:
+            state = self.backend.status(job.id)
+            if state == 'failed':
+                raise RuntimeError('Job {} failed on the server'.format(job.id))
+            if state == 'done':
+                break
+            job.state = state
+            time.sleep(self.poll_interval)
+        # Download next to the final location and move in place, so that
+        # an interrupted download never looks like a cached result
+        directory = os.path.dirname(pops)
+        try:
+            os.makedirs(directory)
+        except OSError as e:  # Other workers may be creating it too
+            if e.errno != errno.EEXIST:
+                raise
+        tmp = tempfile.mkdtemp(dir=directory)
+        try:
+            self.backend.download(job.id, os.path.join(tmp, 'result.pops'), os.path.join(tmp, 'result.pop'))
+            os.rename(os.path.join(tmp, 'result.pop'), pop)
+            os.rename(os.path.join(tmp, 'result.pops'), pops)
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        job.pops, job.pop, job.state = pops, pop, 'done'
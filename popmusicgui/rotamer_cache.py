@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Cache of rotamer searches, keyed by the local environment of the residue.
+
+`useBestRotamers` scores every rotamer of the library against the
+surroundings, which is the expensive part of a mutation. Once a search
+has been done for a residue, target type and criteria, the side chain it
+produced is remembered together with a hash of the neighboring atoms.
+If the same mutation is requested again in the same environment, the
+matching rotamer is placed directly, without scoring.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+from collections import OrderedDict
+import hashlib
+# Additional 3rd parties
+import numpy as np
+# Own
+from spatial import NeighborIndex, atom_coordinates
+
+# Reach of any side chain atom from its alpha carbon (A), with some slack.
+# Mutations change side chains after the residue index is built.
+SIDE_CHAIN_REACH = 8.0
+
+
+class RotamerCache(object):
+
+    """
+    Bounded LRU cache of rotamer outcomes.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Maximum number of outcomes kept
+    reach : float, optional
+        Atoms of other residues closer than this to any atom of the mutated
+        residue are considered part of its environment
+    decimals : int, optional
+        Coordinates are rounded to this many decimals before hashing
+    """
+
+    def __init__(self, maxsize=256, reach=10.0, decimals=2):
+        self.maxsize = maxsize
+        self.reach = reach
+        self.decimals = decimals
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._environments = {}
+        self._residue_indexes = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def identity(residue):
+        molecule = residue.molecule
+        return molecule.id, molecule.subid, residue.id.chainId, residue.id.position
+
+    def environment(self, residue):
+        """
+        Hash of the coordinates of the atoms around `residue`, excluding its own.
+        Only the residues found close enough by `residue_index` are looked at.
+        """
+        own = atom_coordinates(residue.atoms)
+        center = own.mean(axis=0)
+        radius = np.sqrt(((own - center) ** 2).sum(-1)).max() + self.reach
+        residues, anchors, extents, index = self.residue_index(residue.molecule)
+        candidates = index.neighbors(center, radius + extents.max())
+        candidates = candidates[np.sqrt(((anchors[candidates] - center) ** 2).sum(-1))
+                                <= radius + extents[candidates]]
+        others = [a for i in candidates for a in residues[i].atoms if residues[i] is not residue]
+        coords = atom_coordinates(others)
+        nearby = coords[((coords - center) ** 2).sum(-1) <= radius ** 2]
+        return hashlib.sha1(np.round(nearby, self.decimals).tobytes()).hexdigest()
+
+    def residue_index(self, molecule):
+        """
+        Spatial index of the residues of `molecule`, built once per molecule
+        (and again if residues are added or removed).
+
+        Returns
+        -------
+        residues : list of chimera.Residue
+        anchors : np.ndarray, shape (N, 3)
+            Alpha carbon of each residue, or its first atom if it has none.
+            Mutations keep the backbone, so anchors stay valid.
+        extents : np.ndarray, shape (N,)
+            Upper bound of the distance from each anchor to its atoms
+        index : spatial.NeighborIndex
+            Over `anchors`
+        """
+        residues = molecule.residues
+        cached = self._residue_indexes.get(molecule)
+        if cached is not None and len(cached[0]) == len(residues):
+            return cached
+        coords = atom_coordinates([a for r in residues for a in r.atoms])
+        anchors = np.zeros((len(residues), 3))
+        extents = np.zeros(len(residues))
+        start = 0
+        for i, r in enumerate(residues):
+            stop = start + len(r.atoms)
+            names = [a.name for a in r.atoms]
+            if stop > start:
+                anchors[i] = coords[start + names.index('CA')] if 'CA' in names else coords[start]
+                extents[i] = np.sqrt(((coords[start:stop] - anchors[i]) ** 2).sum(-1)).max()
+                if 'CA' in names:
+                    extents[i] = max(extents[i], SIDE_CHAIN_REACH)
+            start = stop
+        cached = self._residue_indexes[molecule] = (list(residues), anchors, extents,
+                                                    NeighborIndex(anchors, self.reach))
+        return cached
+
+    def get(self, residue, new_type, criteria):
+        """
+        Cached side chain for this mutation in the current environment, or None.
+
+        Returns
+        -------
+        entry : dict or None
+            {atom name: (x, y, z)} of the residue after the mutation
+        environment : str
+            Hash of the current environment, to be passed to `put` on a miss
+        """
+        environment = self.environment(residue)
+        key = (self.identity(residue), new_type, criteria, environment)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None, environment
+        self._entries[key] = self._entries.pop(key)  # Mark as recently used
+        self.hits += 1
+        return entry, environment
+
+    def put(self, residue, new_type, criteria, environment):
+        """
+        Remember the current coordinates of `residue`, just mutated to
+        `new_type`, in the `environment` it was mutated in. Outcomes of the
+        same mutation in a previous environment are discarded.
+        """
+        slot = self.identity(residue), new_type, criteria
+        previous = self._environments.get(slot)
+        if previous is not None and previous != environment:
+            self._entries.pop(slot + (previous,), None)
+        self._environments[slot] = environment
+        coords = atom_coordinates(residue.atoms)
+        self._entries[slot + (environment,)] = dict(
+            (a.name, tuple(xyz)) for a, xyz in zip(residue.atoms, coords.tolist()))
+        while len(self._entries) > self.maxsize:
+            key, _ = self._entries.popitem(last=False)
+            if self._environments.get(key[:3]) == key[3]:
+                del self._environments[key[:3]]
+
+    def invalidate(self, residue=None):
+        """
+        Forget the outcomes involving `residue`, or everything if not given
+        """
+        if residue is None:
+            self._entries.clear()
+            self._environments.clear()
+            self._residue_indexes.clear()
+            return
+        identity = self.identity(residue)
+        for key in [k for k in self._entries if k[0] == identity]:
+            del self._entries[key]
+        for slot in [s for s in self._environments if s[0] == identity]:
+            del self._environments[slot]
+
+
+def restore(residue, new_type, coordinates):
+    """
+    Mutate `residue` to `new_type` placing the library rotamer closest to
+    the cached `coordinates`, without any scoring.
+
+    Returns
+    -------
+    bool
+        False if no suitable rotamer was found
+    """
+    from Rotamers import getRotamers, useRotamer
+    _, rotamers = getRotamers(residue, resType=new_type)
+    best, best_rmsd = None, None
+    for rotamer in rotamers:
+        atoms = [a for a in rotamer.residues[0].atoms if a.name in coordinates]
+        if not atoms:
+            continue
+        xyz = np.array([a.coord().data() for a in atoms])
+        ref = np.array([coordinates[a.name] for a in atoms])
+        rmsd = np.sqrt(((xyz - ref) ** 2).sum(-1).mean())
+        if best_rmsd is None or rmsd < best_rmsd:
+            best, best_rmsd = rotamer, rmsd
+    if best is None:
+        return False
+    useRotamer(residue, [best], log=False)
+    return True
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Publish a parsed result set to other processes without copies.
+
+The arrays of `Model.mutations` and a residue index are written once to
+files in shared memory (``/dev/shm`` when available) and described by a
+small, picklable dict. Worker processes map those files read-only, so
+all of them share the same physical pages.
+
+Usage::
+
+    with SharedResults(model) as published:
+        counts = map_chunks(count_stabilizing, published.descriptor, processes=4)
+
+where `count_stabilizing(results, start, stop)` is a module-level function
+receiving an `AttachedResults` and a range of mutation rows.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+from collections import namedtuple
+import multiprocessing
+import os
+import shutil
+import tempfile
+# Additional 3rd parties
+import numpy as np
+# Own
+from columns import MutationColumns
+
+SHARED_MEMORY_DIR = '/dev/shm'
+
+_attached = None  # Per worker, set by the map_chunks initializer
+
+
+class SharedResults(object):
+
+    """
+    Write the columns of `model` to shared memory files.
+
+    Parameters
+    ----------
+    model : core.Model
+        A loaded model
+    directory : str, optional
+        Parent of the created files. Defaults to /dev/shm if writable, or
+        the temporary directory otherwise.
+
+    Attributes
+    ----------
+    descriptor : dict
+        Everything `AttachedResults` needs to map the data
+    """
+
+    def __init__(self, model, directory=None):
+        if directory is None:
+            directory = SHARED_MEMORY_DIR if os.access(SHARED_MEMORY_DIR, os.W_OK) else None
+        self.directory = tempfile.mkdtemp(prefix='popmusic_', dir=directory)
+        mutations = model.mutations
+        arrays = dict(mutations.numeric)
+        arrays.update(('code_' + name, codes) for name, codes in mutations.codes.items())
+        # Residue index: rows of each residue, in `model.residues` order
+        arrays['residue_order'], arrays['residue_bounds'] = mutations.residue_rows(
+            [(r.chain, r.id) for r in model.residues])
+        self.descriptor = {
+            'size': len(mutations),
+            'record': mutations.record.__name__ if mutations.record else 'Mutation',
+            'fields': list(mutations.fields),
+            'vocabularies': dict((name, list(v.values)) for name, v in mutations.vocabularies.items()),
+            'residues': [(r.chain, r.id) for r in model.residues],
+            'arrays': dict((name, self._write(name, array)) for name, array in arrays.items()),
+        }
+
+    def _write(self, name, array):
+        array = np.ascontiguousarray(array)
+        path = os.path.join(self.directory, name + '.bin')
+        if array.size:
+            mapped = np.memmap(path, dtype=array.dtype, mode='w+', shape=array.shape)
+            mapped[...] = array
+            mapped.flush()
+            del mapped
+        return {'path': path, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+
+    def close(self):
+        """
+        Remove the shared files. Processes still attached keep their mappings.
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AttachedResults(object):
+
+    """
+    Read-only view of a result set published with `SharedResults`.
+
+    Parameters
+    ----------
+    descriptor : dict
+        `SharedResults.descriptor`
+
+    Attributes
+    ----------
+    mutations : columns.MutationColumns
+        Backed by the shared arrays
+    residues : list of (chain, id)
+    """
+
+    def __init__(self, descriptor):
+        arrays = dict((name, _map(spec)) for name, spec in descriptor['arrays'].items())
+        fields = descriptor['fields']
+        record = namedtuple(descriptor['record'], fields)
+        codes = dict((name[5:], array) for name, array in arrays.items() if name.startswith('code_'))
+        numeric = dict((name, arrays[name]) for name in fields if name in arrays)
+        self.mutations = MutationColumns.from_arrays(fields, codes, descriptor['vocabularies'],
+                                                     numeric, record=record)
+        self.residues = [tuple(key) for key in descriptor['residues']]
+        self._order = arrays['residue_order']
+        self._bounds = arrays['residue_bounds']
+
+    def __len__(self):
+        return len(self.mutations)
+
+    def residue_rows(self, i):
+        """
+        Indices of the mutation rows of residue `i` (as in `residues`)
+        """
+        return self._order[self._bounds[i]:self._bounds[i + 1]]
+
+    def query(self, **criteria):
+        """
+        Records satisfying `criteria`. See `columns.MutationColumns.mask`.
+        """
+        return self.mutations.rows(self.mutations.query(**criteria))
+
+
+def _map(spec):
+    shape = tuple(spec['shape'])
+    if not np.prod(shape):
+        return np.empty(shape, dtype=spec['dtype'])
+    return np.memmap(spec['path'], dtype=spec['dtype'], mode='r', shape=shape)
+
+
+def _init_worker(descriptor):
+    global _attached
+    _attached = AttachedResults(descriptor)
+
+
+def _run_chunk(task):
+    func, start, stop = task
+    return func(_attached, start, stop)
+
+
+def map_chunks(func, descriptor, processes=None, chunks=None):
+    """
+    Run `func(results, start, stop)` over contiguous ranges of mutation
+    rows in a process pool, where `results` is an `AttachedResults` made
+    once per worker. `func` must be a module-level function.
+
+    Parameters
+    ----------
+    func : callable
+    descriptor : dict
+        `SharedResults.descriptor`
+    processes : int, optional
+        Pool size. Defaults to the number of CPUs.
+    chunks : int, optional
+        Number of row ranges. Defaults to `processes`.
+
+    Returns
+    -------
+    list
+        Return values of `func`, in row order
+    """
+    processes = processes or multiprocessing.cpu_count()
+    chunks = max(1, min(chunks or processes, descriptor['size']))
+    bounds = np.linspace(0, descriptor['size'], chunks + 1).astype(int).tolist()
+    tasks = [(func, start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+    pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(descriptor,))
+    try:
+        return pool.map(_run_chunk, tasks)
+    finally:
+        pool.close()
+        pool.join()
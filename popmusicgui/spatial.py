@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Spatial indexing of residues and atoms: neighbor searches within a radius
+and clustering of residues by proximity.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+from collections import defaultdict
+# Additional 3rd parties
+import numpy as np
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+BACKBONE = frozenset(['N', 'CA', 'C', 'O', 'OXT', 'H', 'HA'])
+
+
+class NeighborIndex(object):
+
+    """
+    Fixed-radius neighbor search over a set of points. Uses a KD-tree
+    (scipy's cKDTree) when available, and a uniform grid of cells with
+    side `radius` otherwise.
+
+    Parameters
+    ----------
+    points : np.ndarray, shape (N, 3)
+    radius : float
+        Maximum distance used in `pairs` and `neighbors`
+    """
+
+    def __init__(self, points, radius):
+        self.points = np.asarray(points, dtype=float).reshape(-1, 3)
+        self.radius = float(radius)
+        if cKDTree is not None:
+            self._tree = cKDTree(self.points)
+        else:
+            self._tree = None
+            self._cells = defaultdict(list)
+            for i, cell in enumerate(map(tuple, np.floor(self.points / self.radius).astype(int))):
+                self._cells[cell].append(i)
+            self._cells = dict((k, np.array(v, dtype=int)) for k, v in self._cells.items())
+
+    def pairs(self):
+        """
+        All (i, j) pairs with i < j closer than `radius`
+
+        Returns
+        -------
+        np.ndarray of int, shape (M, 2)
+        """
+        if self._tree is not None:
+            pairs = np.array(sorted(self._tree.query_pairs(self.radius)), dtype=int)
+            return pairs.reshape(-1, 2)
+        result = []
+        r2 = self.radius ** 2
+        offsets = [(x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1)]
+        for cell, members in self._cells.items():
+            others = [self._cells.get((cell[0] + x, cell[1] + y, cell[2] + z))
+                      for x, y, z in offsets]
+            others = np.concatenate([o for o in others if o is not None])
+            d2 = ((self.points[members][:, None, :] - self.points[others][None, :, :]) ** 2).sum(-1)
+            i, j = np.nonzero(d2 <= r2)
+            i, j = members[i], others[j]
+            keep = i < j
+            result.append(np.column_stack([i[keep], j[keep]]))
+        if not result:
+            return np.empty((0, 2), dtype=int)
+        return np.concatenate(result)
+
+    def neighbors(self, point, radius=None):
+        """
+        Indices of the points closer than `radius` to `point`
+        """
+        radius = self.radius if radius is None else radius
+        point = np.asarray(point, dtype=float)
+        if self._tree is not None:
+            return np.array(sorted(self._tree.query_ball_point(point, radius)), dtype=int)
+        d2 = ((self.points - point) ** 2).sum(-1)
+        return np.flatnonzero(d2 <= radius ** 2)
+
+
+def atom_coordinates(atoms):
+    """
+    Untransformed coordinates of `atoms` as an (N, 3) array, fetched in bulk
+    """
+    try:
+        from _multiscale import get_atom_coordinates
+    except ImportError:
+        return np.array([a.coord().data() for a in atoms], dtype=float).reshape(-1, 3)
+    return get_atom_coordinates(atoms, transformed=False)
+
+
+def residue_coordinates(residues, mode='CA'):
+    """
+    One representative point per residue.
+
+    Parameters
+    ----------
+    residues : list of chimera.Residue
+    mode : str, optional
+        'CA' for alpha carbons, or 'centroid' for side chain centroids
+        (alpha carbon for glycines)
+
+    Returns
+    -------
+    np.ndarray, shape (len(residues), 3)
+        NaN for residues without the required atoms
+    """
+    atoms, owners = [], []
+    for i, residue in enumerate(residues):
+        if residue is None:
+            continue
+        selected = [a for a in residue.atoms if a.name == 'CA']
+        if mode == 'centroid':
+            selected = [a for a in residue.atoms if a.name not in BACKBONE] or selected
+        atoms.extend(selected)
+        owners.extend([i] * len(selected))
+    coords = np.full((len(residues), 3), np.nan)
+    if not atoms:
+        return coords
+    xyz, owners = atom_coordinates(atoms), np.array(owners, dtype=int)
+    counts = np.bincount(owners, minlength=len(residues)).astype(float)
+    sums = np.zeros((len(residues), 3))
+    np.add.at(sums, owners, xyz)
+    present = counts > 0
+    coords[present] = sums[present] / counts[present, None]
+    return coords
+
+
+def cluster(points, radius):
+    """
+    Single-linkage clusters of `points`: connected components of the graph
+    linking points closer than `radius`. NaN points are ignored.
+
+    Returns
+    -------
+    list of np.ndarray of int
+        Indices of each cluster, largest first
+    """
+    points = np.asarray(points, dtype=float)
+    valid = np.flatnonzero(~np.isnan(points).any(axis=1))
+    parent = np.arange(len(valid))
+
+    def root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    if len(valid):
+        for i, j in NeighborIndex(points[valid], radius).pairs():
+            ri, rj = root(i), root(j)
+            if ri != rj:
+                parent[max(ri, rj)] = min(ri, rj)
+    roots = np.array([root(i) for i in range(len(valid))], dtype=int)
+    clusters = [valid[roots == r] for r in np.unique(roots)]
+    return sorted(clusters, key=len, reverse=True)
+
+
+class ContactGraph(object):
+
+    """
+    Residue contact graph: two residues are in contact if any of their
+    atoms are closer than `cutoff`.
+
+    Parameters
+    ----------
+    residues : list of chimera.Residue
+    cutoff : float, optional
+        Atom-atom distance (A) defining a contact
+    adjacency : dict, optional
+        Already computed `adjacency` of an identical set of residues
+
+    Attributes
+    ----------
+    adjacency : dict
+        {residue index: set of residue indices in contact}
+    """
+
+    def __init__(self, residues, cutoff=5.0, adjacency=None):
+        self.residues = list(residues)
+        self.cutoff = cutoff
+        self._index = dict((r, i) for i, r in enumerate(self.residues))
+        if adjacency is not None:
+            self.adjacency = adjacency
+            return
+        atoms, owners = [], []
+        for i, residue in enumerate(self.residues):
+            atoms.extend(residue.atoms)
+            owners.extend([i] * len(residue.atoms))
+        owners = np.array(owners, dtype=int)
+        self.adjacency = dict((i, set()) for i in range(len(self.residues)))
+        if not atoms:
+            return
+        pairs = owners[NeighborIndex(atom_coordinates(atoms), cutoff).pairs()]
+        pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+        for i, j in set(map(tuple, np.sort(pairs, axis=1).tolist())):
+            self.adjacency[i].add(j)
+            self.adjacency[j].add(i)
+
+    def conflicts(self, residues):
+        """
+        Pairs of `residues` that are in contact with each other
+        """
+        indices = set(self._index[r] for r in residues if r in self._index)
+        return [(self.residues[i], self.residues[j]) for i in sorted(indices)
+                for j in sorted(self.adjacency[i] & indices) if i < j]
+
+    def schedule(self, residues):
+        """
+        Split `residues` in batches of mutually independent (not in contact)
+        residues, by greedy coloring of the contact subgraph, highest degree
+        first. Residues unknown to the graph go in the first batch.
+
+        Returns
+        -------
+        list of lists of chimera.Residue
+        """
+        indices = set(self._index[r] for r in residues if r in self._index)
+        degree = dict((i, len(self.adjacency[i] & indices)) for i in indices)
+        color = {}
+        for i in sorted(indices, key=lambda i: (-degree[i], i)):
+            used = set(color[j] for j in self.adjacency[i] if j in color)
+            color[i] = next(c for c in range(len(used) + 1) if c not in used)
+        batches = [[] for _ in range(max(color.values()) + 1 if color else 1)]
+        for r in residues:
+            batches[color.get(self._index.get(r), 0)].append(r)
+        return [batch for batch in batches if batch]
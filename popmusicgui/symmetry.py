@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+Merging of identical chains (homo-oligomers), so that their PoPMuSiC data
+is stored and displayed once, and copied back to every chain when needed.
+"""
+
+from __future__ import print_function, division
+# Python stdlib
+from collections import OrderedDict, defaultdict
+# Additional 3rd parties
+import numpy as np
+
+
+class ChainMap(object):
+
+    """
+    Groups of chains with identical sequences. The first chain of each
+    group is its reference; the residues of the other chains are mapped to
+    the reference residue at the same index.
+
+    Parameters
+    ----------
+    residues : list of core.NamedResidue
+        Summary rows of all chains, in file order
+
+    Attributes
+    ----------
+    reference : dict
+        {chain: reference chain}
+    copies : OrderedDict
+        {reference chain: [chains with the same sequence, reference first]}
+    """
+
+    def __init__(self, residues):
+        chains = OrderedDict()
+        for r in residues:
+            chains.setdefault(r.chain, []).append(r)
+        self.reference, self.copies, by_sequence = {}, OrderedDict(), {}
+        for chain, rows in chains.items():
+            reference = by_sequence.setdefault(tuple(r.residue_type for r in rows), chain)
+            self.reference[chain] = reference
+            self.copies.setdefault(reference, []).append(chain)
+        self.keys = [(r.chain, r.id) for r in residues]
+        self._to_reference = {}
+        self._equivalents = defaultdict(list)
+        for chain, rows in chains.items():
+            for r, ref in zip(rows, chains[self.reference[chain]]):
+                self._to_reference[(r.chain, r.id)] = ref.chain, ref.id
+                self._equivalents[(ref.chain, ref.id)].append((r.chain, r.id))
+
+    @property
+    def order(self):
+        """
+        Largest number of identical chains
+        """
+        return max(len(chains) for chains in self.copies.values()) if self.copies else 1
+
+    def __bool__(self):
+        return self.order > 1
+    __nonzero__ = __bool__
+
+    def to_reference(self, key):
+        """
+        (chain, id) of the reference residue equivalent to `key`
+        """
+        return self._to_reference.get(key, key)
+
+    def equivalents(self, key):
+        """
+        (chain, id) of every residue equivalent to `key`, itself included
+        """
+        return self._equivalents.get(self.to_reference(key), [key])
+
+    def collapse(self, datapop, residues):
+        """
+        Keep the rows of reference chains only, averaging every numeric
+        value over the copies of each residue (and mutation).
+
+        Parameters
+        ----------
+        datapop : list of core.PopTuple
+        residues : list of core.NamedResidue
+            Their `mutations` are left as they are; they should be built
+            from the collapsed `datapop`
+
+        Returns
+        -------
+        datapop, residues
+            Same types, for reference chains only
+        """
+        groups = OrderedDict()
+        for m in datapop:
+            chain, position = self.to_reference((m.chain, m.id))
+            groups.setdefault((chain, position, m.residue_mutated), []).append(m)
+        merged_pop = []
+        for (chain, position, _), rows in groups.items():
+            first = next((m for m in rows if m.chain == chain), rows[0])
+            merged_pop.append(first._replace(chain=chain, id=position, sa=_mean(m.sa for m in rows),
+                                             ddG=_mean(m.ddG for m in rows)))
+
+        by_key = dict(((r.chain, r.id), r) for r in residues)
+        merged = []
+        for r in residues:
+            if self.reference[r.chain] != r.chain:
+                continue
+            copies = [by_key[k] for k in self.equivalents((r.chain, r.id))]
+            merged.append(r._replace(
+                solvent_accessibility=_mean(c.solvent_accessibility for c in copies),
+                ddG=_mean(c.ddG for c in copies),
+                negative_score=_mean(c.negative_score for c in copies),
+                positive_score=_mean(c.positive_score for c in copies)))
+        return merged_pop, merged
+
+    def broadcast(self, residues):
+        """
+        Rows for every chain, in the original order, copied from the
+        (collapsed) reference `residues`. Copies share the mutations dict.
+        """
+        rows = dict(((r.chain, r.id), r) for r in residues)
+        result = []
+        for chain, position in self.keys:
+            row = rows.get(self.to_reference((chain, position)))
+            if row is not None:
+                result.append(row._replace(chain=chain, id=position))
+        return result
+
+
+def _mean(values):
+    return float(np.mean(list(values)))